@@ -6,31 +6,33 @@
     -Christopher Welborn 08-15-2014
 """
 
-from collections import OrderedDict
+from array import array
+from bisect import bisect_left
+from collections import Counter, deque, namedtuple, OrderedDict
 from datetime import datetime
-from docopt import docopt
+import codecs
+import io
+import itertools
+import json
 import os
 import platform
 import re
 import sqlite3
+import struct
 import sys
+import threading
+import time
+import unicodedata
 
 
-# Try importing the spell-check helper.
+# The spell-check helper is imported on first use, see load_spellchecker().
 # This only works if ASpell is installed, and spell.py is available.
-try:
-    import spell
-except ImportError:
-    # Spell checking will not be available. :(
-    spell = None
-    spellchecker = None
-else:
-    try:
-        spellchecker = spell.SpellChecker()
-    except spell.SpellChecker.NotSupported:
-        # ASpell is not available.
-        spell = None
-        spellchecker = None
+spell = None
+spellchecker = None
+# Set once load_spellchecker() has run, whether it worked or not.
+spellchecker_loaded = False
+# The compiled --grep pattern, in each worker process. See grep_init().
+grepregex = None
 
 NAME = 'Define'
 VERSION = '0.0.3'
@@ -38,57 +40,764 @@ VERSIONSTR = '{} v. {}'.format(NAME, VERSION)
 SCRIPT = os.path.split(os.path.abspath(sys.argv[0]))[1]
 SCRIPTDIR = os.path.abspath(sys.path[0])
 OS = platform.system().lower()
+# Default maximum number of completions for --complete.
+COMPLETELIMIT = 100
+# Default maximum number of similar words for --fuzzy, and suggestions.
+FUZZYLIMIT = 10
+# Maximum number of words that are ranked when finding similar words.
+FUZZYCANDIDATES = 200
+# Minimum similarity (0-1) for a word to be considered similar.
+FUZZYMINSCORE = 0.3
+# Maximum number of words ending like a word that are checked for rhymes.
+RHYMECANDIDATES = 5000
+# Default number of links to follow from a word, for --follow.
+FOLLOWDEPTH = 1
+# Shortest word to find with --anagram --sub.
+ANAGRAMMIN = 2
+# Longest word for --anagram --sub, every subset of its letters is tried.
+ANAGRAMMAX = 16
+# Number of signatures to look up in each query, for --anagram --sub.
+ANAGRAMBATCH = 500
+# Environment variable for extra dictionaries to search.
+DICTSVAR = 'DEFINE_DICTS'
+# Separates a dictionary file name from its priority ('glossary.txt@10').
+# This can't be os.pathsep, which separates the names in DICTSVAR.
+PRIORITYSEP = '@'
+# Environment variable to remember spelling suggestions between runs.
+SPELLCACHEVAR = 'DEFINE_SPELLCACHE'
+# Default number of worker threads for --http.
+HTTPWORKERS = 8
+# Seconds to keep an idle --http connection open, or to wait for the rest
+# of a request.
+HTTPTIMEOUT = 30
+# Largest request body accepted by --http.
+HTTPMAXBODY = 1024 * 1024
+# Upper bounds (in milliseconds) for the --http latency histogram.
+HTTPBUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000)
+# Number of definitions in each piece of work for --grep, in a database.
+GREPROWS = 5000
+# Number of bytes in each piece of work for --grep, in a text file.
+GREPBYTES = 1024 * 1024
+# Pieces of work queued for each --grep worker, ahead of the results.
+GREPQUEUE = 2
+# Default memory budget (in megabytes) for all of the --preload sources.
+PRELOADBUDGET = 256
 USAGESTR = """{versionstr}
     Usage:
         {script} -h | -v
-        {script} -c OUTPUTFILE
-        {script} WORD...
+        {script} -c OUTPUTFILE [-f format]
+        {script} --anagram WORD... [--sub] [-n num]
+        {script} --complete [PREFIX] [-n num]
+        {script} (--ends-with SUFFIX | --rhyme WORD...) [-g] [-n num]
+                 [--definitions]
+        {script} --completion-script SHELL
+        {script} --fuzzy WORD... [-n num]
+        {script} --list [PREFIX] [-p pos] [-n num]
+        {script} [-d file]... (WORD... [--auto] [--first | -s num] [-p pos]
+                 [--follow [--depth num]] [--preload [--budget mb]]
+                 | --grep PATTERN [-n num] [-w num]
+                 | --http ADDRESS [-w num] [--preload [--budget mb]]
+                 | --stats)
 
     Options:
-        OUTPUTFILE    : File name for conversions.
-        WORD          : Word or words to search for.
-        -c,--convert  : Convert dictionary file to an sqlite3 database.
-        -h,--help     : Show this help message.
-        -v,--version  : Show version.
-""".format(script=SCRIPT, versionstr=VERSIONSTR)
+        ADDRESS                   : Host and port to serve on, like
+                                    localhost:8080.
+        OUTPUTFILE                : File name for conversions.
+        PATTERN                   : Python regular expression to search
+                                    for. Use (?i) to ignore case.
+        PREFIX                    : Start of a word to complete or list.
+        SUFFIX                    : End of the words to list.
+        SHELL                     : Shell to generate a completion
+                                    script for (bash or zsh).
+        WORD                      : Word or words to search for.
+        -c,--convert              : Convert dictionary file to an sqlite3
+                                    database.
+        -d file,--dict file       : Extra dictionary to search, an sqlite3
+                                    database or a plain text file.
+                                    A priority can be added to the name,
+                                    like 'glossary.sqlite3{prioritysep}10'.
+                                    Higher priorities are shown first.
+        --ends-with               : List the words that end with SUFFIX.
+        -f fmt,--format fmt       : Format for conversions. One of:
+                                    sqlite, ndjson, records, tsv
+                                    Default: guessed from the OUTPUTFILE
+                                    extension, or sqlite.
+        --budget mb               : Memory budget for --preload, in
+                                    megabytes. Dictionaries that don't
+                                    fit are searched on disk.
+                                    Default: {preloadbudget}
+        --anagram                 : List the words in the dictionary
+                                    that are anagrams of WORD.
+        --auto                    : When a word isn't found, show the
+                                    best spelling suggestion that is in
+                                    the dictionary instead, and list the
+                                    others that are.
+        --complete                : List words starting with PREFIX,
+                                    for shell tab-completion.
+        --completion-script       : Print a shell completion script that
+                                    uses --complete.
+        --definitions             : Also show the definition of each word,
+                                    for --ends-with and --rhyme.
+        --depth num               : Number of links to follow from each
+                                    word, for --follow.
+                                    Default: {followdepth}
+        --first                   : Only show the first sense of the
+                                    first definition.
+        --follow                  : Also show the words that are referred
+                                    to ("See ...") and the synonyms.
+        --fuzzy                   : List similar words in the dictionary.
+        -g,--group                : Group words that rhyme, for
+                                    --ends-with and --rhyme.
+        --grep                    : List the definitions that have a
+                                    match for PATTERN.
+        --http                    : Serve definitions as JSON over HTTP.
+        -h,--help                 : Show this help message.
+        --list                    : List the words starting with PREFIX.
+        -n num,--count num        : Maximum number of completions,
+                                    anagrams, rhymes, similar words, or
+                                    matching definitions for --grep.
+                                    Default: {completelimit} completions,
+                                             anagrams, rhymes, and
+                                             matches,
+                                             {fuzzylimit} similar words.
+        -p pos,--pos pos          : Only show definitions for this part
+                                    of speech, like n, v, a, adv, or
+                                    noun, verb, adjective, adverb.
+        --preload                 : Load the dictionaries into memory
+                                    first, for many lookups.
+        --rhyme                   : List the words that rhyme with WORD.
+        -s num,--sense num        : Only show this numbered sense of each
+                                    definition.
+        --stats                   : Show database and spell checker
+                                    diagnostics, and any problems that
+                                    would make lookups slow.
+        --sub                     : Also list words that use some of the
+                                    letters, for --anagram.
+        -v,--version              : Show version.
+        -w num,--workers num      : Number of requests to handle at once,
+                                    for --http, or processes to search
+                                    with, for --grep.
+                                    Default: {httpworkers} for --http,
+                                             one for each CPU for
+                                             the --grep search.
+
+    Shell completion for bash can be enabled with:
+        eval "$({script} --completion-script bash)"
+
+    Extra dictionaries can also be set in ${dictsvar}, separated
+    by '{pathsep}'.
+
+    Spelling suggestions are remembered between runs when
+    ${spellcachevar} is set to 1, like `spell.py -C` does.
+
+    The --http service answers:
+        GET  /define/WORD         : Definitions for a word.
+        GET  /suggest/WORD        : Spelling suggestions for a word.
+        POST /batch               : Definitions for a JSON list of words.
+        GET  /metrics             : Request counts and latencies.
+""".format(
+    script=SCRIPT,
+    versionstr=VERSIONSTR,
+    completelimit=COMPLETELIMIT,
+    fuzzylimit=FUZZYLIMIT,
+    followdepth=FOLLOWDEPTH,
+    dictsvar=DICTSVAR,
+    spellcachevar=SPELLCACHEVAR,
+    httpworkers=HTTPWORKERS,
+    preloadbudget=PRELOADBUDGET,
+    pathsep=os.pathsep,
+    prioritysep=PRIORITYSEP)
 
 DICTFILE = os.path.join(SCRIPTDIR, 'websters_dict_plain.txt')
 DICTDB = os.path.join(SCRIPTDIR, 'websters_dict_plain.sqlite3')
+DICTENCODING = 'utf-8'
+# Version of the database layout, stored in `PRAGMA user_version`.
+# 2: Definitions are also stored as senses, see split_senses().
+# 3: Cross-references and synonyms are stored as links, see find_links().
+# 4: Words have a sorted-letter signature, see word_signature().
+# 5: Words are also stored reversed, for suffix searches.
+# 6: Each definition's part of speech and etymology are stored as entries.
+# 7: Words have a normalized key for lookups, see word_key().
+SCHEMAVERSION = 7
+# Size of each read when scanning the dictionary file.
+CHUNKSIZE = 1024 * 1024
+
+# This is what the words look like in the file.
+WORDPAT = re.compile('^[A-Z\\-]+$')
+# This is what the numbered list of defs look like.
+LISTPAT = re.compile('^[1-9]{1,3}\\.')
+# Start of a definition.
+DEFSTART = 'Defn: '
+# End of the definitions.
+ENDMARKERS = ('*** END', 'End of Project')
+# Headword lines in a piece of the file from iter_chunks(), where every line
+# starts after a line break. Like WORDPAT, but the lines aren't stripped.
+HEADWORDPAT = re.compile(
+    '\\n[^\\S\\n]*([A-Z\\-]+)[^\\S\\n]*$',
+    re.MULTILINE)
+# Line breaks before a numbered definition or a definition start, in
+# stripped lines (see format_lines()).
+SENSEBREAKPAT = re.compile('\\n(?:{}|(?={}))'.format(
+    re.escape(DEFSTART),
+    LISTPAT.pattern.lstrip('^')))
+# Kinds of senses, see split_senses().
+SENSE_HEAD = 'head'
+SENSE_LIST = 'list'
+SENSE_DEFN = 'defn'
+# Kinds of links between words, see find_links().
+LINK_SEE = 'see'
+LINK_SYN = 'syn'
+# Labels for related words, for --follow.
+LINKLABELS = {LINK_SEE: 'See also:', LINK_SYN: 'Synonym:'}
+# Cross-references, like "See Apple." or "See under Apple."
+SEEPAT = re.compile(r'\bSee (?:also )?(?:Note )?(?:under )?([A-Z][\w\-]*)')
+# Synonym lists, like "Syn. -- Fruit; pome." up to the end of the sense.
+SYNPAT = re.compile(r'\bSyn\. --(.*?)(?:\n\n|$)', re.DOTALL)
+# A single word in a synonym list.
+SYNWORDPAT = re.compile(r'^[A-Za-z][A-Za-z\-]*$')
+# Characters that are left out of normalized keys, see word_key().
+KEYDROP = str.maketrans('', '', '-\'\u2019')
+# Part of speech in a definition header, like "Apple, n." or "Abate, v. t."
+POSPAT = re.compile(r'^[^,\n]*,\s*((?:[a-z]+\.\s*)+)')
+# Etymology in a definition header, like "Etym: [L. apple.]"
+ETYMPAT = re.compile(r'Etym: \[([^\]]*)\]')
+# Names for the parts of speech, and the abbreviations they are stored as.
+POSNAMES = {
+    'noun': 'n',
+    'verb': 'v',
+    'adjective': 'a',
+    'adj': 'a',
+    'adverb': 'adv',
+    'pronoun': 'pron',
+    'preposition': 'prep',
+    'conjunction': 'conj',
+    'interjection': 'interj',
+}
+# The part of a word that rhymes: the last vowels, and what follows them.
+# A silent E at the end goes with the vowels before it ('AKE' in 'CAKE').
+RHYMEPAT = re.compile('[AEIOUY]+(?:[^AEIOUY]+E|[^AEIOUY]*)$')
+# Worker threads per source, for Dictionary lookups in several sources.
+SOURCETHREADS = 4
+# Indexes that lookups need, as (table, column, index name).
+DBINDEXES = (
+    ('words', 'word', 'idx_words_word'),
+    ('words', 'normalized', 'idx_words_normalized'),
+    ('definitions', 'word_id', 'idx_definitions_word_id'),
+    ('senses', 'word_id', 'idx_senses_word_id'),
+    ('links', 'word_id', 'idx_links_word_id'),
+    ('words', 'signature', 'idx_words_signature'),
+    ('words', 'reversed', 'idx_words_reversed'),
+    ('entries', 'word_id', 'idx_entries_word_id'),
+    ('entries', 'pos', 'idx_entries_pos'),
+)
+# Free pages (as a fraction of all pages) worth running VACUUM for.
+DBFREELIMIT = 0.25
+
+# A definition found by Dictionary, with the name of its source.
+Definition = namedtuple('Definition', ['word', 'source', 'text'])
+# Part of a definition found by Dictionary.lookup_senses().
+# `entry` is the index of the definition for the word, in its source.
+Sense = namedtuple(
+    'Sense',
+    ['word', 'source', 'entry', 'sense', 'kind', 'text'])
 
 
 def main(argd):
     """ Main entry point, expects docopt arg dict as argd """
 
+    if argd['--anagram']:
+        return main_anagram(
+            argd['WORD'],
+            sub=argd['--sub'],
+            count=argd['--count'])
+    if argd['--complete']:
+        return main_complete(argd['PREFIX'], count=argd['--count'])
+    if argd['--ends-with'] or argd['--rhyme']:
+        return main_suffix(
+            [argd['SUFFIX']] if argd['--ends-with'] else argd['WORD'],
+            rhyme=argd['--rhyme'],
+            group=argd['--group'],
+            definitions=argd['--definitions'],
+            count=argd['--count'])
+    if argd['--completion-script']:
+        return print_completion_script(argd['SHELL'])
+    if argd['--fuzzy']:
+        return main_fuzzy(argd['WORD'], count=argd['--count'])
+    if argd['--list']:
+        return main_list(
+            argd['PREFIX'],
+            pos=argd['--pos'],
+            count=argd['--count'])
+    if argd['--stats']:
+        return main_stats(argd['--dict'])
+    if argd['--grep']:
+        return main_grep(
+            argd['PATTERN'],
+            dictfiles=argd['--dict'],
+            workers=argd['--workers'],
+            count=argd['--count'])
+    if argd['--http']:
+        return main_http(
+            argd['ADDRESS'],
+            dictfiles=argd['--dict'],
+            workers=argd['--workers'],
+            preload=argd['--preload'],
+            budget=argd['--budget'])
+
     if argd['--convert']:
         print('Converting file: {}'.format(DICTFILE))
         outfile = argd['OUTPUTFILE']
         if outfile == '-':
             outfile = DICTDB
+        fmt = argd['--format'] or export_format(outfile)
+        if (fmt != 'sqlite') and (fmt not in EXPORTFORMATS):
+            print_fail('Unknown format: {}'.format(fmt))
         if not confirm_file(outfile):
             print('\nUser cancelled.\n')
             return 1
 
-        convert_sqlite(outfile)
+        if fmt == 'sqlite':
+            convert_sqlite(outfile)
+        else:
+            count = convert_export(outfile, fmt)
+            print('Exported {} definitions.'.format(count))
         print('\nFinished with the conversion: {}'.format(outfile))
         return 1
 
-    ret = 0
+    try:
+        sense = int(argd['--sense']) if argd['--sense'] else None
+    except ValueError:
+        print_fail('Invalid number for --sense: {}'.format(argd['--sense']))
+    if argd['--first']:
+        sense = 1
+    pos = pos_key(argd['--pos']) if argd['--pos'] else None
+    if not os.path.exists(DICTDB):
+        print('\nNo database file present, falling back to text.')
+    # Every word, and every root word that may be tried, is looked up at
+    # once. All of the dictionaries are searched at the same time, and
+    # without a database this is a single pass over the text file.
+    targets = []
     for word in argd['WORD']:
-        print_status('Searching for:', value=word)
-        lastret = find_definition(word)
-        # Exit code shows how many errors there were.
-        ret += lastret
+        targets.append(word)
+        targets.extend(root_words(word))
+    sources = load_sources(argd['--dict'])
+    if argd['--preload']:
+        sources = preload_sources(sources, budget=argd['--budget'])
+    with Dictionary(sources, onerror=print_source_error) as dictionary:
+        lookupstart = datetime.now()
+        senses = dictionary.lookup_senses(targets, sense=sense, pos=pos)
+        # Every word's time includes the lookup they shared.
+        lookuptime = datetime.now() - lookupstart
+        ret = 0
+        # Links are followed from the headwords that were shown, not from
+        # every root word that might have been tried.
+        shown = []
+        for word in argd['WORD']:
+            print_status('Searching for:', value=word)
+            lastret = find_definition(
+                word,
+                dictionary=dictionary,
+                senses=senses,
+                sense=sense,
+                pos=pos,
+                first=argd['--first'],
+                auto=argd['--auto'],
+                shown=shown,
+                starttime=datetime.now() - lookuptime)
+            # Exit code shows how many errors there were.
+            ret += lastret
+        if argd['--follow']:
+            try:
+                depth = int(argd['--depth'] or FOLLOWDEPTH)
+            except ValueError:
+                print_fail('Invalid number for --depth: {}'.format(
+                    argd['--depth']))
+            print_related(
+                dictionary,
+                shown,
+                depth=depth,
+                sense=sense,
+                pos=pos)
     return ret
 
 
-# Color-coding for definitions.
-if OS.startswith('win'):
-    # No support for Windows, yet.
-    colorword = colordef = colorlist = lambda s: s
-else:
-    colorword = lambda s: color(s, fore='green', style='bold')
-    colordef = lambda s: color(s, fore='blue')
-    colorlist = lambda s: color(s, fore='grey')
+def main_anagram(words, sub=False, count=None):
+    """ Print the anagrams in the dictionary for each word.
+        Returns the number of words with no anagrams.
+    """
+    limit = parse_count(count)
+    ret = 0
+    with Dictionary(onerror=print_source_error) as dictionary:
+        for word in words:
+            try:
+                anagrams = dictionary.anagrams(word, sub=sub, limit=limit)
+            except ValueError as ex:
+                print_fail(str(ex))
+            if not anagrams:
+                print_status('No anagrams for:', value=word)
+                ret += 1
+                continue
+            print_status('Anagrams of:', value=word)
+            print_corrections([w.lower() for w in anagrams])
+    return ret
+
+
+def main_complete(prefix, count=None):
+    """ Print completions for a word prefix, one per line.
+        This is also called directly for `--complete`, without docopt.
+    """
+    try:
+        limit = int(count) if count else COMPLETELIMIT
+    except ValueError:
+        print('Invalid number for --count: {}'.format(count), file=sys.stderr)
+        return 1
+    words = complete_word(prefix or '', limit=limit)
+    if words:
+        print('\n'.join(words))
+    return 0
+
+
+def main_fuzzy(words, count=None):
+    """ Print similar words from the dictionary for each word.
+        Returns the number of words with no similar words.
+    """
+    limit = parse_count(count, default=FUZZYLIMIT)
+    ret = 0
+    with Dictionary(onerror=print_source_error) as dictionary:
+        results = [(w, dictionary.similar(w, limit=limit)) for w in words]
+    for word, similar in results:
+        if not similar:
+            print_status('No similar words for:', value=word)
+            ret += 1
+            continue
+        print_status('Similar to:', value=word)
+        longest = max(len(w) for w, _ in similar)
+        for similarword, score in similar:
+            print('    {} {}'.format(
+                colorword(similarword.ljust(longest)),
+                colordef('{:.2f}'.format(score))))
+    return ret
+
+
+def main_grep(pattern, dictfiles=None, workers=None, count=None):
+    """ Print the definitions that match a regular expression, with their
+        headwords, in dictionary order. See iter_grep().
+        Returns 1 if nothing matched.
+    """
+    try:
+        re.compile(pattern)
+    except re.error as ex:
+        print_fail('Invalid pattern: {}'.format(pattern), exc=ex)
+    limit = parse_count(count)
+    try:
+        workers = int(workers) if workers else (os.cpu_count() or 1)
+    except ValueError:
+        print_fail('Invalid number for --workers: {}'.format(workers))
+    sources = load_sources(dictfiles)
+    found = 0
+    matches = iter_grep(sources, pattern, workers=workers, limit=limit)
+    for source, word, definition, spans in matches:
+        found += 1
+        if len(sources) > 1:
+            print(colorsource('[{}]'.format(source.name)))
+        print(colorword(word))
+        for line in format_grep_lines(definition, spans):
+            print('    {}'.format(line))
+    if not found:
+        print_status('No matches for:', value=pattern)
+        return 1
+    return 0
+
+
+def main_http(
+        address, dictfiles=None, workers=None, preload=False, budget=None):
+    """ Serve definitions as JSON over HTTP until interrupted.
+        Requests are handled by a fixed number of worker threads, which
+        also limits the number of database connections. Spelling
+        suggestions share one aspell process.
+        With `preload`, the dictionaries are loaded into memory first,
+        see preload_sources().
+    """
+    try:
+        host, port = parse_address(address)
+    except ValueError as ex:
+        print_fail(str(ex))
+    try:
+        workers = int(workers) if workers else HTTPWORKERS
+    except ValueError:
+        print_fail('Invalid number for --workers: {}'.format(workers))
+    checker = load_spellchecker()
+    if checker is not None:
+        checker.open_pipe()
+    sources = load_sources(dictfiles)
+    if preload:
+        sources = preload_sources(sources, budget=budget)
+    with Dictionary(sources, onerror=print_source_error) as dictionary:
+        try:
+            server = http_server(dictionary, host, port, workers=workers)
+        except EnvironmentError as ex:
+            print_fail('Unable to serve on: {}'.format(address), exc=ex)
+        print_status(
+            'Serving on:',
+            value='http://{}:{}/'.format(*server.server_address[:2]))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            print_status('\nStopping...')
+        finally:
+            server.server_close()
+            if checker is not None:
+                checker.close_pipe()
+    return 0
+
+
+def main_list(prefix, pos=None, count=None):
+    """ Print the words starting with a prefix, optionally only the words
+        with a definition for a part of speech.
+        Returns 1 if no words were found.
+    """
+    limit = parse_count(count)
+    pos = pos_key(pos) if pos else None
+    with Dictionary(onerror=print_source_error) as dictionary:
+        found = dictionary.words(prefix or '', pos=pos, limit=limit)
+    if pos:
+        print_status('Part of speech:', value=pos)
+    if not found:
+        print_status('No words found for:', value=prefix or '*')
+        return 1
+    print_status('Words starting with:', value=prefix or '*')
+    print_corrections([w.lower() for w in found])
+    return 0
+
+
+def main_stats(dictfiles=None):
+    """ Print diagnostics for each dictionary, and the spell checker.
+        Returns the number of problems found.
+    """
+    problems = []
+    for source in load_sources(dictfiles):
+        print_status('\nDictionary:', value=source.name)
+        if isinstance(source, DBSource):
+            try:
+                stats = db_stats(source.filename)
+            except (EnvironmentError, sqlite3.Error) as ex:
+                print_status('    Database:', value=source.filename)
+                print_error('Unable to read the database: {}'.format(ex))
+                stats = None
+            if stats is not None:
+                print_db_stats(stats)
+                if source.filename == DICTDB:
+                    rebuild = None
+                else:
+                    rebuild = 'Recreate it like `{} -c` does.'.format(SCRIPT)
+                problems.extend(
+                    (source.name, problem, fix)
+                    for problem, fix in db_problems(stats, rebuild=rebuild))
+            textsource = source.fallback
+        else:
+            textsource = source
+        if textsource is None:
+            continue
+        print_status('    Text file:', value=textsource.filename)
+        if (source is textsource) and (source.filename == DICTFILE):
+            # Small text glossaries are fine, but Webster's is not.
+            problems.append((
+                source.name,
+                'No database, every lookup reads the text file.',
+                'Convert it with `{} -c -`.'.format(SCRIPT)))
+        if not os.path.exists(textsource.filename):
+            problems.append((
+                source.name,
+                'The text file is missing.',
+                'Restore {}.'.format(textsource.filename)))
+
+    checker = load_spellchecker()
+    print_status(
+        '\nAspell:',
+        value=checker.aspell_exe if checker else 'not available')
+    if checker is not None:
+        print_status(
+            '    Cache file:',
+            value=checker.cache.filename or 'none, set ${}=1'.format(
+                SPELLCACHEVAR))
+    if checker is None:
+        problems.append((
+            'aspell',
+            'Aspell is not available, suggestions only use the dictionaries.',
+            'Install aspell, and make sure spell.py is next to define.py.'))
+
+    if not problems:
+        print_status('\nNo problems found.')
+        return 0
+    print_status('\nProblems:')
+    for name, problem, fix in problems:
+        print('    {}: {}'.format(colorword(name), problem))
+        print('        {}'.format(colordef(fix)))
+    return len(problems)
+
+
+def main_suffix(
+        words, rhyme=False, group=False, definitions=False, count=None):
+    """ Print the words that end with each suffix, or rhyme with each word
+        when `rhyme` is set.
+        Returns the number of suffixes/words with no results.
+    """
+    limit = parse_count(count)
+    ret = 0
+    with Dictionary(onerror=print_source_error) as dictionary:
+        for word in words:
+            if rhyme:
+                found = dictionary.rhymes(word, limit=limit)
+                label = 'Rhymes with:'
+            else:
+                found = dictionary.ends_with(word, limit=limit)
+                label = 'Words ending with:'
+            if not found:
+                print_status('No words found for:', value=word)
+                ret += 1
+                continue
+            print_status(label, value=word)
+            if group:
+                groups = OrderedDict()
+                for foundword in found:
+                    groups.setdefault(rhyme_key(foundword), []).append(
+                        foundword)
+            else:
+                groups = {None: found}
+            for key, groupwords in groups.items():
+                if key is not None:
+                    print_status('  -{}:'.format(key.lower()))
+                if not definitions:
+                    print_corrections([w.lower() for w in groupwords])
+                    continue
+                senses = dictionary.lookup_senses(groupwords)
+                for groupword in groupwords:
+                    print('\n{}'.format(format_senses(
+                        senses[groupword],
+                        labeled=len(dictionary.sources) > 1)))
+    return ret
+
+
+def anagram_matcher(word, sub=False):
+    """ Returns a function that checks whether a headword is an anagram
+        of `word`, or uses some of its letters when `sub` is set.
+        This is for searching without the signature index.
+    """
+    signature = word_signature(word)
+    if not sub:
+        return lambda w: word_signature(w) == signature
+    letters = Counter(signature)
+    return lambda w: (
+        len(word_signature(w)) >= ANAGRAMMIN and
+        not (Counter(word_signature(w)) - letters))
+
+
+def bisect_key(order, target, key):
+    """ Find the first place in `order` where key(item) >= target, like
+        bisect.bisect_left() with a key function.
+        Arguments:
+            order   : Sequence that is sorted by key(item).
+            target  : Value to look for.
+            key     : Function that returns the sort value for an item.
+    """
+    lo, hi = 0, len(order)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if key(order[mid]) < target:
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
+
+
+def complete_word(prefix, limit=COMPLETELIMIT):
+    """ Find up to `limit` words that start with `prefix`, in sorted order.
+        This uses an index range query on the database when it's available,
+        and falls back to scanning the headwords in the plain text file.
+        Returns a list of lowercase words, or [] when nothing matches.
+    """
+    prefix = prefix.upper()
+    if os.path.exists(DICTDB):
+        try:
+            con = sqlite3.connect(DICTDB)
+            try:
+                return complete_word_indb(con.cursor(), prefix, limit=limit)
+            finally:
+                con.close()
+        except sqlite3.Error:
+            pass
+
+    try:
+        with open(DICTFILE, 'rb') as f:
+            return complete_word_infile(f, prefix, limit=limit)
+    except EnvironmentError:
+        return []
+
+
+def complete_word_indb(cursor, prefix, limit=COMPLETELIMIT):
+    """ Find words starting with `prefix` using a range query on the
+        words.word index.
+        Arguments:
+            cursor  : sqlite3 connection cursor (sqlite3.connect(DICTDB)).
+            prefix  : uppercase start of a word ('APP').
+            limit   : maximum number of words to return.
+    """
+    if prefix:
+        # Everything from 'APP' up to (but not including) 'APQ'.
+        upper = ''.join((prefix[:-1], chr(ord(prefix[-1]) + 1)))
+        rows = cursor.execute(''.join((
+            'SELECT DISTINCT word FROM words ',
+            'WHERE word >= ? AND word < ? ORDER BY word LIMIT ?;'
+        )), (prefix, upper, limit))
+    else:
+        rows = cursor.execute(
+            'SELECT DISTINCT word FROM words ORDER BY word LIMIT ?;',
+            (limit,))
+    return [r[0].lower() for r in rows]
+
+
+def complete_word_infile(f, prefix, limit=COMPLETELIMIT):
+    """ Find words starting with `prefix` by scanning the headwords in an
+        open dictionary file. This is much slower than the database.
+    """
+    words = {w for w in iter_headwords(f) if w.startswith(prefix)}
+    return [w.lower() for w in sorted(words)[:limit]]
+
+
+def completion_script(shell):
+    """ Build a shell completion script that calls `--complete`.
+        Arguments:
+            shell  : Name of the shell, 'bash' or 'zsh'.
+        Raises ValueError for unknown shells.
+    """
+    scripts = {
+        'bash': '''
+_{funcname}_complete() {{
+    local cur="${{COMP_WORDS[COMP_CWORD]}}"
+    case "$cur" in
+        -*) return 0 ;;
+    esac
+    COMPREPLY=($({exe} --complete "$cur" 2>/dev/null))
+}}
+complete -F _{funcname}_complete {script}
+''',
+        'zsh': '''
+#compdef {script}
+_{funcname}_complete() {{
+    local -a completions
+    completions=(${{(f)"$({exe} --complete "$PREFIX" 2>/dev/null)"}})
+    compadd -U -a completions
+}}
+compdef _{funcname}_complete {script}
+''',
+    }
+    template = scripts.get(shell.lower(), None)
+    if template is None:
+        raise ValueError('Unsupported shell: {}'.format(shell))
+    return template.format(
+        exe=os.path.abspath(sys.argv[0]),
+        funcname=re.sub('[^A-Za-z0-9_]', '_', SCRIPT),
+        script=SCRIPT).strip()
 
 
 def confirm(question):
@@ -108,22 +817,28 @@ def confirm_file(filename):
     return confirm('This file exists: {}\n\nOverwrite it?'.format(filename))
 
 
-def convert_pickle(outputfile):
-    """ Convert the dictionary to an OrderedDict, and then pickle it. """
-    import pickle
-    with open(DICTFILE, 'r') as fin:
-        with open(outputfile, 'wb') as fout:
-            fout.write(pickle.dumps(dict_words(fin)))
+def convert_export(outputfile, fmt):
+    """ Convert the dictionary to one of the EXPORTFORMATS.
+        Definitions are streamed from the dictionary file straight to the
+        output file, so the whole dictionary is never held in memory.
+        Returns the number of definitions written.
+    """
+    writer = EXPORTFORMATS[fmt][0]
+    with open(DICTFILE, 'rb') as fin:
+        with open(outputfile, 'wb', buffering=CHUNKSIZE) as fout:
+            return writer(iter_definitions(fin), fout)
 
 
 def convert_sqlite(outputfile):
     """ Convert the dictionary to an SQLite database. """
     con = create_sqlite_db(outputfile)
     cursor = con.cursor()
-    with open(DICTFILE, 'r') as fin:
+    with open(DICTFILE, 'rb') as fin:
         for word, defs in dict_words(fin).items():
             insert_into_sqlite_db(cursor, word, defs)
     con.commit()
+    index_sqlite_db(cursor)
+    con.commit()
     con.close()
 
 
@@ -140,7 +855,10 @@ def create_sqlite_db(outputfile):
     cur.execute(''.join((
         'CREATE TABLE words (',
         'id INTEGER PRIMARY KEY,'
-        'word TEXT',
+        'word TEXT,',
+        'signature TEXT,',
+        'reversed TEXT,',
+        'normalized TEXT',
         ');'
     )))
     con.commit()
@@ -151,10 +869,186 @@ def create_sqlite_db(outputfile):
         ');'
     )))
     con.commit()
+    # Trigrams for finding similar words, see word_trigrams().
+    cur.execute(''.join((
+        'CREATE TABLE trigrams (',
+        'trigram TEXT,',
+        'word_id REFERENCES words(id),',
+        'PRIMARY KEY (trigram, word_id)',
+        ') WITHOUT ROWID;'
+    )))
+    # Definitions split into parts, see split_senses().
+    cur.execute(''.join((
+        'CREATE TABLE senses (',
+        'word_id INTEGER REFERENCES words(id),',
+        'entry INTEGER,',
+        'sense INTEGER,',
+        'kind TEXT,',
+        'text TEXT',
+        ');'
+    )))
+    # Words that a word refers to, see find_links().
+    cur.execute(''.join((
+        'CREATE TABLE links (',
+        'word_id INTEGER REFERENCES words(id),',
+        'kind TEXT,',
+        'target TEXT',
+        ');'
+    )))
+    # Part of speech and etymology for each definition, see parse_header().
+    # The word is repeated, so words can be listed by part of speech from
+    # the index alone.
+    cur.execute(''.join((
+        'CREATE TABLE entries (',
+        'word_id INTEGER REFERENCES words(id),',
+        'entry INTEGER,',
+        'word TEXT,',
+        'pos TEXT,',
+        'etym TEXT',
+        ');'
+    )))
+    cur.execute('PRAGMA user_version = {};'.format(SCHEMAVERSION))
+    con.commit()
 
     return con
 
 
+def db_problems(stats, rebuild=None):
+    """ Look for problems in the results of db_stats().
+        Arguments:
+            stats    : Results from db_stats().
+            rebuild  : How to rebuild the database, for problems that
+                       need it.
+                       Default: Rebuilding Webster's with `define -c`.
+        Returns a list of [(problem, suggested fix)].
+    """
+    rebuild = rebuild or 'Rebuild it with `{} -c -`.'.format(SCRIPT)
+    problems = []
+    if stats['user_version'] < SCHEMAVERSION:
+        problems.append((
+            'The database layout is old (version {}, expecting {}).'.format(
+                stats['user_version'],
+                SCHEMAVERSION),
+            rebuild))
+    if 'trigrams' not in stats['rows']:
+        problems.append((
+            'There is no trigrams table, similar words aren\'t available.',
+            rebuild))
+    for table, column, name in DBINDEXES:
+        if column not in stats['columns'].get(table, ()):
+            # Missing tables mean an old layout, which is reported above.
+            continue
+        if (table, column) not in stats['indexed']:
+            problems.append((
+                'There is no index on {}({}).'.format(table, column),
+                'Run `CREATE INDEX {} ON {}({});` on the database.'.format(
+                    name,
+                    table,
+                    column)))
+    for detail in stats['plan']:
+        if detail.startswith('SCAN') and ('INDEX' not in detail):
+            problems.append((
+                'Lookups read every row: {}'.format(detail),
+                'Add the missing index. {}'.format(rebuild)))
+    pagecount = stats['page_count'] or 1
+    if stats['freelist_count'] / pagecount > DBFREELIMIT:
+        problems.append((
+            '{:.0%} of the database is unused space.'.format(
+                stats['freelist_count'] / pagecount),
+            'Run `VACUUM;` on the database.'))
+    return problems
+
+
+def db_stats(filename):
+    """ Gather diagnostics for a dictionary database.
+        Raises FileNotFoundError if it doesn't exist, or sqlite3.Error.
+        Returns a dict with the file size, page info, schema version,
+        row counts and columns by table, index names, indexed
+        (table, column)s, and the query plans for lookups (a list of
+        strings).
+    """
+    if not os.path.exists(filename):
+        raise FileNotFoundError('No such file: {}'.format(filename))
+    con = sqlite3.connect(filename)
+    try:
+        cur = con.cursor()
+        stats = {'filename': filename, 'size': os.path.getsize(filename)}
+        for pragma in (
+                'page_size', 'page_count', 'freelist_count', 'user_version'):
+            stats[pragma] = cur.execute(
+                'PRAGMA {};'.format(pragma)).fetchone()[0]
+        tables = [
+            row[0] for row in cur.execute(
+                'SELECT name FROM sqlite_master WHERE type == \'table\';')
+        ]
+        stats['rows'] = OrderedDict(
+            (table, cur.execute(
+                'SELECT COUNT(*) FROM "{}";'.format(table)).fetchone()[0])
+            for table in tables)
+        stats['columns'] = {
+            table: [
+                row[1] for row in cur.execute(
+                    'PRAGMA table_info("{}");'.format(table))
+            ]
+            for table in tables
+        }
+        stats['indexes'] = OrderedDict()
+        stats['indexed'] = set()
+        for name, table in cur.execute(''.join((
+                'SELECT name, tbl_name FROM sqlite_master ',
+                'WHERE type == \'index\' ORDER BY tbl_name, name;'
+                ))).fetchall():
+            stats['indexes'][name] = table
+            columns = cur.execute(
+                'PRAGMA index_info("{}");'.format(name)).fetchall()
+            if columns:
+                stats['indexed'].add((table, columns[0][2]))
+        # Older databases are searched by exact headword, see
+        # DBSource.keyed().
+        normalized = 'normalized' in stats['columns'].get('words', ())
+        stats['plan'] = [
+            row[-1] for row in cur.execute(
+                'EXPLAIN QUERY PLAN {}'.format(
+                    entries_query(1, normalized=normalized)),
+                ('WORD',))
+        ]
+        if 'senses' in stats['rows']:
+            stats['plan'].extend(
+                row[-1] for row in cur.execute(
+                    'EXPLAIN QUERY PLAN {}'.format(
+                        senses_query(1, 1, normalized=normalized)),
+                    ('WORD', 1)))
+    finally:
+        con.close()
+    return stats
+
+
+def define_words(dictionary, words):
+    """ Look up definitions for the --http service. Root words are tried
+        when a word isn't found, like find_definition() does.
+        Returns a dict of {word: {'definitions': [...], 'root': root}},
+        where `root` is the root word that was found, or None.
+    """
+    targets = []
+    for word in words:
+        targets.append(word)
+        targets.extend(root_words(word))
+    definitions = dictionary.lookup_many(targets)
+    results = {}
+    for word in words:
+        result = {'definitions': [], 'root': None}
+        for tryword in [word] + root_words(word):
+            if definitions[tryword]:
+                result['definitions'] = [
+                    d._asdict() for d in definitions[tryword]
+                ]
+                if tryword != word:
+                    result['root'] = tryword
+                break
+        results[word] = result
+    return results
+
+
 def dict_words(fileobj):
     """ Iterate over the entire file, and produce a dict of {word: [defs,]} """
     defs = OrderedDict()
@@ -166,48 +1060,192 @@ def dict_words(fileobj):
     return defs
 
 
-def find_definition(word, _attempts=0, _starttime=None, _origword=None):
+def entries_query(count, normalized=True):
+    """ Returns the query that find_entries_indb() uses for `count` words.
+        If `normalized` is set, the words are matched by their normalized
+        keys (see word_key()), otherwise they must match exactly.
+    """
+    # definitions.word_id has no type, so the unary + is needed for its
+    # index to be used.
+    return ''.join((
+        'SELECT words.word, definitions.text FROM words JOIN definitions ',
+        'ON definitions.word_id == +words.id ',
+        'WHERE words.{} IN ({}) '.format(
+            'normalized' if normalized else 'word',
+            ', '.join('?' * count)),
+        'ORDER BY definitions.rowid;'
+    ))
+
+
+def export_format(filename):
+    """ Guess the export format for a file name, by extension.
+        Returns 'sqlite' for anything that isn't an export file.
+    """
+    ext = os.path.splitext(filename)[1].lower()
+    return EXPORTEXTS.get(ext, 'sqlite')
+
+
+def find_anagrams_indb(cursor, word, sub=False):
+    """ Find the anagrams of a word with the signature index. With `sub`,
+        every subset of the letters is looked up, a batch at a time.
+        Returns a list of uppercase words.
+        Raises sqlite3.Error for databases without signatures.
+    """
+    signature = word_signature(word)
+    signatures = sub_signatures(signature) if sub else [signature]
+    found = []
+    for i in range(0, len(signatures), ANAGRAMBATCH):
+        batch = signatures[i:i + ANAGRAMBATCH]
+        found.extend(row[0] for row in cursor.execute(''.join((
+            'SELECT DISTINCT word FROM words ',
+            'WHERE signature IN ({});'.format(', '.join('?' * len(batch)))
+        )), batch))
+    return found
+
+
+def find_anagrams_infile(f, word, sub=False):
+    """ Find the anagrams of a word by scanning the headwords in an open
+        dictionary file. This is much slower than the database.
+        Returns a list of uppercase words.
+    """
+    matches = anagram_matcher(word, sub=sub)
+    return list(OrderedDict.fromkeys(filter(matches, iter_headwords(f))))
+
+
+def find_definition(
+        word, dictionary=None, senses=None, sense=None, pos=None,
+        first=False, auto=False, shown=None, starttime=None, _attempts=0,
+        _origword=None):
     """ Trys to find the definition for a word. If it can't find it, it will
         check for misspelled words.
+        Arguments:
+            word         : Word to find.
+            dictionary   : Dictionary to search.
+                           Default: A new Dictionary().
+            senses       : Optional dict of {word: [Sense]} from
+                           Dictionary.lookup_senses(), with the same
+                           `sense`. Words that are in it aren't searched
+                           for again.
+            sense        : Only show this numbered sense.
+            pos          : Only show definitions for this part of speech,
+                           see pos_key().
+            first        : Only show the first definition that was found.
+            auto         : If the word is misspelled, show the best
+                           suggestion that is in the dictionary instead.
+            shown        : Optional list. The headwords that are shown
+                           (which may be a root word, a suggestion, or
+                           another spelling) are added to it.
+            starttime    : When the lookup started, for the time that is
+                           shown. `senses` should be looked up after it.
+                           Default: datetime.now()
     """
-    if _starttime is None:
-        _starttime = datetime.now()
+    if dictionary is None:
+        with Dictionary(onerror=print_source_error) as dictionary:
+            return find_definition(
+                word,
+                dictionary=dictionary,
+                senses=senses,
+                sense=sense,
+                pos=pos,
+                first=first,
+                auto=auto,
+                shown=shown)
+    if starttime is None:
+        starttime = datetime.now()
     if _origword is None:
         _origword = word
-    definition = find_word(word)
-    duration = (datetime.now() - _starttime)
-    if definition:
+    if (senses is not None) and (word in senses):
+        found = senses[word]
+    else:
+        found = dictionary.lookup_senses(
+            (word,), sense=sense, pos=pos)[word]
+    if (not found) and pos and dictionary.exists(word):
+        print_status('No {}. definitions for:'.format(pos), value=word)
+        return 1
+    if found and (sense is not None):
+        # Definitions without the sense only have their header.
+        hassense = {
+            (s.source, s.word, s.entry)
+            for s in found if s.kind != SENSE_HEAD
+        }
+        found = [
+            s for s in found if (s.source, s.word, s.entry) in hassense
+        ]
+        if not found:
+            print_status('No sense {} for:'.format(sense), value=word)
+            return 1
+    if first and found:
+        firstentry = (found[0].source, found[0].word, found[0].entry)
+        found = [
+            s for s in found if (s.source, s.word, s.entry) == firstentry
+        ]
+    duration = (datetime.now() - starttime)
+    if found:
+        definition = format_senses(
+            found,
+            labeled=len(dictionary.sources) > 1)
         print(''.join(('\n', definition)))
+        if shown is not None:
+            shown.extend(
+                w for w in OrderedDict.fromkeys(s.word for s in found)
+                if w not in shown)
         timestr = '{:.3f}'.format(duration.total_seconds())
         print_status('\nTime:', value=timestr)
         return 0
 
     # See if the word is misspelled.
     if _attempts == 0:
-        otherwords = get_suggestions(word)
-        if otherwords:
+        otherwords = dictionary.suggest(word)
+        roots = {w.lower() for w in root_words(word)}
+        if otherwords and roots.isdisjoint(w.lower() for w in otherwords):
             # The word may have been misspelled.
             print_status('Can\'t find:', value=word)
+            if auto:
+                # Suggestions aren't always in the dictionary. They are
+                # all looked up at once, and the best one is shown.
+                ranked = rank_suggestions(word, otherwords)
+                found = dictionary.lookup_senses(ranked, sense=sense, pos=pos)
+                valid = [w for w in ranked if found[w]]
+                if valid:
+                    print_status('Showing', valid[0], 'instead...')
+                    ret = find_definition(
+                        valid[0],
+                        dictionary=dictionary,
+                        senses=found,
+                        sense=sense,
+                        pos=pos,
+                        first=first,
+                        shown=shown,
+                        _attempts=_attempts + 1,
+                        starttime=starttime,
+                        _origword=_origword)
+                    if len(valid) > 1:
+                        print_status('\nAlso in the dictionary:')
+                        print_corrections(valid[1:])
+                    return ret
             # suggestvals = ' '.join(otherwords)
             print_status('Did you mean one of these?:')
-            spell.print_corrections(otherwords)
+            print_corrections(otherwords)
             return 1
 
     # Can't find alternative spellings,
     # Try the root word, like 'slay' instead of 'slayed' where applicable.
     # This is setup to try only one more time after the initial attempt.
     if _attempts < 2:
-        tryword = None
-        if word.endswith(('ed', 'er', 'es')):
-            tryword = word[:-2]
-        elif word.endswith(('ing', 'ify', 'ize')):
-            tryword = word[:-3]
+        tryword = root_word(word)
         if tryword:
             print_status('Trying', tryword, 'instead...')
             return find_definition(
                 tryword,
+                dictionary=dictionary,
+                senses=senses,
+                sense=sense,
+                pos=pos,
+                first=first,
+                auto=auto,
+                shown=shown,
                 _attempts=_attempts + 1,
-                _starttime=_starttime,
+                starttime=starttime,
                 _origword=_origword)
     else:
         print_status('Too many attempts,', 'giving up.')
@@ -215,36 +1253,247 @@ def find_definition(word, _attempts=0, _starttime=None, _origword=None):
     return 1
 
 
+def find_endmarker(text):
+    """ Find the first line in a piece of the dictionary file that starts
+        with one of the ENDMARKERS, after any leading whitespace.
+        This uses str.find() instead of a regex, which would have to be
+        tried at every line.
+        Returns the index where the line starts, or None.
+    """
+    end = None
+    for marker in ENDMARKERS:
+        index = text.find(marker)
+        while index != -1:
+            linestart = text.rfind('\n', 0, index) + 1
+            if not text[linestart:index].strip():
+                if (end is None) or (linestart < end):
+                    end = linestart
+                break
+            index = text.find(marker, index + 1)
+    return end
+
+
+def find_entries_indb(cursor, words, normalized=True):
+    """ Make SQLite3 find several words in a single query.
+        Arguments:
+            cursor      : sqlite3 connection cursor (sqlite3.connect(DICTDB)).
+            words       : words to find (['myword', 'otherword']).
+            normalized  : Find every headword with the same normalized key
+                          (see word_key()), like 'TO-DAY' for 'today'.
+                          Older databases only have exact headwords.
+
+        Returns a dict of {WORD: [definition]} for the headwords that were
+        found, with plain (uncolored) definitions.
+        Raises sqlite3.Error for `normalized` in older databases.
+    """
+    words = lookup_keys(words, normalized)
+    if not words:
+        return {}
+    rows = cursor.execute(
+        entries_query(len(words), normalized),
+        tuple(words)).fetchall()
+    found = OrderedDict()
+    for word, text in rows:
+        found.setdefault(word, []).append(text)
+    return found
+
+
+def find_entries_infile(f, words):
+    """ Does the actual work of searching for several words in one pass
+        over an open file object.
+        The search stops early once every word has been found, and the
+        entries following its last duplicate have been reached.
+        Only the entries for `words` are formatted, see iter_entries().
+        Returns a dict of {WORD: [definition]} for the words that were
+        found, with plain (uncolored) definitions.
+    """
+    # Words in the file are uppercase.
+    remaining = {w.upper() for w in words}
+    found = OrderedDict()
+    lastword = None
+    for word, definition in iter_entries(f, remaining):
+        if definition == '':
+            # Empty entries are skipped, like iter_definitions() does.
+            continue
+        if (word != lastword) and (lastword in found):
+            # Our word is finished.
+            remaining.discard(lastword)
+            if not remaining:
+                break
+        if word in remaining:
+            found.setdefault(word, []).append(definition)
+        lastword = word
+    return found
+
+
+def find_existing_indb(cursor, words, normalized=True):
+    """ Find out which words are in the database, in a single query.
+        With `normalized`, every headword with the same normalized key
+        is found, see find_entries_indb().
+        Returns a set of the uppercase headwords that were found.
+    """
+    words = lookup_keys(words, normalized)
+    if not words:
+        return set()
+    rows = cursor.execute(''.join((
+        'SELECT DISTINCT word FROM words ',
+        'WHERE {} IN ({});'.format(
+            'normalized' if normalized else 'word',
+            ', '.join('?' * len(words)))
+    )), tuple(words))
+    return {r[0] for r in rows}
+
+
+def find_links(definitions):
+    """ Find the words that definitions refer to, like "See Apple.",
+        and the single words in synonym lists, like "Syn. -- Fruit; pome."
+        Returns a list of [(kind, WORD)] without duplicates, in order,
+        where kind is LINK_SEE or LINK_SYN.
+    """
+    links = OrderedDict()
+    for definition in definitions:
+        for target in SEEPAT.findall(definition):
+            links.setdefault((LINK_SEE, target.upper()), None)
+        for synonyms in SYNPAT.findall(definition):
+            for synonym in re.split('[;,]', synonyms):
+                synonym = synonym.strip().rstrip('.')
+                if SYNWORDPAT.match(synonym):
+                    links.setdefault((LINK_SYN, synonym.upper()), None)
+    return list(links)
+
+
+def find_links_indb(cursor, words, normalized=True):
+    """ Find the links for several words in a single query.
+        With `normalized`, the links of every headword with the same
+        normalized key are found, see find_entries_indb().
+        Returns a dict of {WORD: [(kind, WORD)]} for the headwords that have
+        links, see find_links().
+        Raises sqlite3.Error for databases without links.
+    """
+    words = lookup_keys(words, normalized)
+    if not words:
+        return {}
+    rows = cursor.execute(''.join((
+        'SELECT words.word, links.kind, links.target FROM words JOIN links ',
+        'ON links.word_id == words.id ',
+        'WHERE words.{} IN ({}) '.format(
+            'normalized' if normalized else 'word',
+            ', '.join('?' * len(words))),
+        'ORDER BY links.rowid;'
+    )), tuple(words)).fetchall()
+    found = OrderedDict()
+    for word, kind, target in rows:
+        found.setdefault(word, []).append((kind, target))
+    return found
+
+
+def find_senses_indb(cursor, words, sense=None, pos=None, normalized=True):
+    """ Find the senses for several words in a single query.
+        Arguments:
+            cursor      : sqlite3 connection cursor (sqlite3.connect(DICTDB)).
+            words       : words to find (['myword', 'otherword']).
+            sense       : Only find this numbered sense, and the headers.
+            pos         : Only find definitions for this part of speech
+                          ('v').
+            normalized  : Find every headword with the same normalized
+                          key, see find_entries_indb().
+
+        Returns a dict of {WORD: [(entry, sense, kind, text)]} for the
+        headwords that were found, in order.
+        Raises sqlite3.Error for databases without senses, or without
+        entries when `pos` is given.
+    """
+    words = lookup_keys(words, normalized)
+    if not words:
+        return {}
+    args = list(words)
+    if sense is not None:
+        args.append(sense)
+    if pos is not None:
+        args.append(pos)
+    rows = cursor.execute(
+        senses_query(len(words), sense, pos, normalized),
+        args).fetchall()
+    found = OrderedDict()
+    for word, entry, number, kind, text in rows:
+        found.setdefault(word, []).append((entry, number, kind, text))
+    return found
+
+
+def find_similar_indb(cursor, word, limit=FUZZYLIMIT):
+    """ Find similar words using the trigrams table.
+        The words sharing the most trigrams with `word` are ranked by
+        similarity (shared trigrams / all trigrams of both words).
+        Only FUZZYCANDIDATES words are ranked, no matter how common the
+        trigrams are.
+        Arguments:
+            cursor  : sqlite3 connection cursor (sqlite3.connect(DICTDB)).
+            word    : word to find similar words for ('myword').
+            limit   : maximum number of words to return.
+        Returns a list of [('word', similarity)], best matches first.
+    """
+    trigrams = word_trigrams(word)
+    rows = cursor.execute(''.join((
+        'SELECT words.word, candidates.shared FROM words JOIN (',
+        'SELECT word_id, COUNT(*) AS shared FROM trigrams ',
+        'WHERE trigram IN ({}) '.format(', '.join('?' * len(trigrams))),
+        'GROUP BY word_id ORDER BY shared DESC LIMIT ?',
+        ') AS candidates ON words.id == candidates.word_id;'
+    )), tuple(trigrams) + (FUZZYCANDIDATES,)).fetchall()
+
+    upperword = word.upper()
+    similar = []
+    for candidate, shared in rows:
+        if candidate == upperword:
+            continue
+        total = len(trigrams) + len(word_trigrams(candidate)) - shared
+        score = shared / total
+        if score >= FUZZYMINSCORE:
+            similar.append((candidate.lower(), score))
+    similar.sort(
+        key=lambda ws: (-ws[1], abs(len(ws[0]) - len(word)), ws[0]))
+    return similar[:limit]
+
+
+def find_suffix_indb(cursor, suffix, limit=COMPLETELIMIT):
+    """ Find words ending with `suffix` using a range query on the
+        words.reversed index.
+        Arguments:
+            cursor  : sqlite3 connection cursor (sqlite3.connect(DICTDB)).
+            suffix  : uppercase end of a word ('TION').
+            limit   : maximum number of words to return.
+        Returns a list of uppercase words, sorted by their endings.
+        Raises sqlite3.Error for databases without reversed words.
+    """
+    start = suffix[::-1]
+    # Everything from 'NOIT' up to (but not including) 'NOIU'.
+    end = ''.join((start[:-1], chr(ord(start[-1]) + 1)))
+    # Headwords are unique, without DISTINCT the index order is used.
+    rows = cursor.execute(''.join((
+        'SELECT word FROM words ',
+        'WHERE reversed >= ? AND reversed < ? ORDER BY reversed LIMIT ?;'
+    )), (start, end, limit))
+    return [row[0] for row in rows]
+
+
+def find_suffix_infile(f, suffix, limit=COMPLETELIMIT):
+    """ Find words ending with `suffix` by scanning the headwords in an
+        open dictionary file. This is much slower than the database.
+        Returns a list of uppercase words, sorted by their endings.
+    """
+    words = {w for w in iter_headwords(f) if w.endswith(suffix)}
+    return sorted(words, key=lambda w: w[::-1])[:limit]
+
+
 def find_word(word):
-    """ Opens the plain text dictionary file and searches for a word
-        and definition.
+    """ Searches the dictionary database, or the plain text dictionary file
+        when there is no database, for a word and definition.
         If no word is found, '' is returned.
-        If the word is found, the definition is returned as str.
+        If the word is found, the color-formatted definition is returned as
+        str.
     """
-    # Try the database first.
-    if os.path.exists(DICTDB):
-        try:
-            con = sqlite3.connect(DICTDB)
-        except EnvironmentError as exsqlite:
-            print_error(
-                'Unable to open the database: {}'.format(DICTDB, exc=exsqlite))
-            print('\nFalling back to the plain text file.')
-        else:
-            try:
-                results = find_word_indb(con.cursor(), word)
-            except sqlite3.OperationalError:
-                print('\nFalling back to the plain text file.')
-            else:
-                return results
-    else:
-        print('\nNo database file present, falling back to text.')
-
-    # DB Failed, try the old fashioned method.
-    try:
-        with open(DICTFILE, 'r') as f:
-            return find_word_infile(f, word)
-    except EnvironmentError as ex:
-        print_fail('Error opening dict file: {}'.format(DICTFILE), exc=ex)
+    with Dictionary(onerror=print_source_error) as dictionary:
+        return format_definitions(dictionary.lookup(word))
 
 
 def find_word_indb(cursor, word):
@@ -259,12 +1508,10 @@ def find_word_indb(cursor, word):
 
         Returns a color-formatted string on success, empty str on failure.
     """
-
-    rows = cursor.execute(''.join((
-        'SELECT text FROM definitions JOIN words ',
-        'WHERE words.word=? and words.id == definitions.word_id;'
-    )), (word.upper(),)).fetchall()
-    return format_db_results(word, [r[0] for r in rows])
+    found = find_entries_indb(cursor, (word,))
+    # Every headword that was found has the same normalized key.
+    definitions = [d for headword in found for d in found[headword]]
+    return format_db_results(word, definitions)
 
 
 def find_word_infile(f, word):
@@ -272,97 +1519,339 @@ def find_word_infile(f, word):
         If no word is found, '' is returned.
         If the word is found, the definition is returned as str.
     """
-    # This is what the words look like in the file.
-    wordpat = re.compile('^[A-Z\-]+$')
-    # This is what the numbered list of defs look like.
-    listpat = re.compile('^[1-9]{1,3}\.')
-    # Start of a definition
-    defstart = 'Defn: '
-    defstartlen = len(defstart)
-    trimdefstart = lambda s: s[defstartlen:]
-    formatdefstart = lambda s: ''.join(('\n', trimdefstart(s)))
-    # This will be our result.
-    deflines = []
-    formatted_defs = lambda: '\n'.join(deflines).strip()
+    definitions = find_entries_infile(f, (word,)).get(word.upper(), [])
+    return format_db_results(word, definitions).strip()
 
-    # Words in the file are uppercase.
-    word = word.upper()
-    for line in f:
-        l = line.strip()
-        if not l:
-            # Blank line
-            continue
-        if l.startswith(('*** END', 'End of Project')):
-            # End of definitions.
-            return formatted_defs()
-        if wordpat.match(l):
-            if deflines:
-                # This is the next word.
-                # If it's another definition of our word, continue.
-                # Otherwise return what we have.
-                if l == word:
-                    deflines.append(''.join(('\n', colorword(l))))
-                else:
-                    return formatted_defs()
-            else:
-                # We haven't found the word yet.
-                # See if this one matches.
-                if l == word:
-                    # This is the word, add it to the output.
-                    deflines.append(colorword(l))
-        else:
-            if not deflines:
-                continue
-            # This is part of a definition.
-            # If we have already added some lines,
-            # this is part of OUR definition.
-            if listpat.match(l):
-                deflines.append(''.join(('\n', colorlist(l))))
-            else:
-                if l.startswith(defstart):
-                    # Beginning of definition.
-                    deflines.append(colordef(formatdefstart(l)))
-                else:
-                    # Rest of the def.
-                    deflines.append(colordef(l))
-    # We haven't found anything,
-    # or possibly the last word in the file.
-    return formatted_defs()
+
+def find_words_indb(cursor, prefix, pos, limit=COMPLETELIMIT):
+    """ Find words starting with `prefix` that have a definition for a part
+        of speech, using a range query on the entries.pos index.
+        Arguments:
+            cursor  : sqlite3 connection cursor (sqlite3.connect(DICTDB)).
+            prefix  : uppercase start of a word ('PRE'), or ''.
+            pos     : part of speech, see pos_key() ('v').
+            limit   : maximum number of words to return.
+        Returns a list of uppercase words, in sorted order.
+        Raises sqlite3.Error for databases without entries.
+    """
+    if prefix:
+        upper = ''.join((prefix[:-1], chr(ord(prefix[-1]) + 1)))
+        rows = cursor.execute(''.join((
+            'SELECT DISTINCT word FROM entries ',
+            'WHERE pos == ? AND word >= ? AND word < ? ',
+            'ORDER BY word LIMIT ?;'
+        )), (pos, prefix, upper, limit))
+    else:
+        rows = cursor.execute(''.join((
+            'SELECT DISTINCT word FROM entries ',
+            'WHERE pos == ? ORDER BY word LIMIT ?;'
+        )), (pos, limit))
+    return [row[0] for row in rows]
+
+
+def find_words_infile(f, prefix, pos=None, limit=COMPLETELIMIT):
+    """ Find words starting with `prefix`, optionally only those with a
+        definition for a part of speech, by scanning an open dictionary
+        file. This is much slower than the database.
+        Returns a list of uppercase words, in sorted order.
+    """
+    if pos is None:
+        words = {w for w in iter_headwords(f) if w.startswith(prefix)}
+    else:
+        words = {
+            word for word, definition in iter_definitions(f)
+            if word.startswith(prefix)
+            and parse_header(definition)[0] == pos
+        }
+    return sorted(words)[:limit]
 
 
 def format_db_results(word, results):
     """ Colors a definition list retrieved from the database. """
-    listpat = re.compile('^[1-9]{1,3}\.')
     formatted = []
     for deftext in results:
         # Putting the word here matches plain text results.
         formatted.append('\n{}'.format(colorword(word.upper())))
         for line in deftext.split('\n'):
-            if listpat.match(line):
+            if LISTPAT.match(line):
                 formatted.append(colorlist(line))
             else:
                 formatted.append(colordef(line))
     return '\n'.join(formatted)
 
 
+def format_definitions(definitions, labeled=False):
+    """ Colors a list of Definitions from a Dictionary, grouped by source.
+        If `labeled` is truthy, each group is labeled with the source name.
+        Returns '' when there are no definitions.
+    """
+    groups = OrderedDict()
+    for definition in definitions:
+        key = (definition.source, definition.word)
+        groups.setdefault(key, []).append(definition.text)
+    formatted = []
+    for (source, word), texts in groups.items():
+        text = format_db_results(word, texts).strip()
+        if labeled:
+            text = '\n'.join((colorsource('[{}]'.format(source)), text))
+        formatted.append(text)
+    return '\n\n'.join(formatted)
+
+
+def format_grep_lines(definition, spans):
+    """ Returns the lines of a definition that have --grep matches in
+        them, with the matches highlighted.
+        Arguments:
+            definition  : Definition that was searched.
+            spans       : (start, end) of each match, in order.
+    """
+    lines = []
+    lastline = None
+    for start, _ in spans:
+        linestart = definition.rfind('\n', 0, start) + 1
+        if linestart == lastline:
+            continue
+        lastline = linestart
+        lineend = definition.find('\n', start)
+        if lineend == -1:
+            lineend = len(definition)
+        pieces = []
+        pos = linestart
+        for matchstart, matchend in spans:
+            # Matches can span lines, only this line's part is shown.
+            matchstart = max(matchstart, linestart)
+            matchend = min(matchend, lineend)
+            if matchstart >= matchend:
+                continue
+            pieces.append(colordef(definition[pos:matchstart]))
+            pieces.append(colorword(definition[matchstart:matchend]))
+            pos = matchend
+        pieces.append(colordef(definition[pos:lineend]))
+        lines.append(''.join(pieces))
+    return lines
+
+
+def format_lines(text):
+    """ Format the lines of one entry in the dictionary file the way
+        iter_definitions() shows it. Lines are stripped, blank lines are
+        removed, and numbered definitions and definition starts get a blank
+        line before them, without the 'Defn: ' part.
+        This must not run before the headwords are found, a line like
+        'Defn: A' would look like a headword afterwards.
+    """
+    text = '\n'.join(filter(None, map(str.strip, text.split('\n'))))
+    if not text:
+        return ''
+    return SENSEBREAKPAT.sub('\n\n', ''.join(('\n', text)))
+
+
+def format_senses(senses, labeled=False):
+    """ Colors a list of Senses from Dictionary.lookup_senses().
+        If `labeled` is truthy, each source is labeled with its name.
+        Returns '' when there are no senses.
+    """
+    formatted = []
+    lastsource = lastentry = None
+    for sense in senses:
+        wordfmt = '\n{}'
+        if sense.source != lastsource:
+            if labeled:
+                formatted.append('\n{}'.format(
+                    colorsource('[{}]'.format(sense.source))))
+                wordfmt = '{}'
+            lastentry = None
+        if (sense.word, sense.entry) != lastentry:
+            # Putting the word here matches plain text results.
+            formatted.append(wordfmt.format(colorword(sense.word)))
+        elif sense.kind != SENSE_HEAD:
+            formatted.append('')
+        lastsource, lastentry = sense.source, (sense.word, sense.entry)
+        if sense.kind == SENSE_LIST:
+            first, _, rest = sense.text.partition('\n')
+            formatted.append(colorlist(first))
+            if rest:
+                formatted.append(colordef(rest))
+        else:
+            formatted.append(colordef(sense.text))
+    return '\n'.join(formatted).strip()
+
+
 def get_suggestions(word):
-    """ Get spelling suggestions for a word,
-        only if SpellChecker is properly initialized.
+    """ Get spelling suggestions for a word, see Dictionary.suggest().
 
         Warning:
-            This sometimes suggests words that aren't in the definitions file.
+            ASpell sometimes suggests words that aren't in the definitions
+            file.
 
         Returns a list of suggestions, or None  on failure.
     """
-    if spellchecker:
+    with Dictionary(onerror=print_source_error) as dictionary:
+        return dictionary.suggest(word) or None
+
+
+def grep_chunk(task):
+    """ Search part of a dictionary for the --grep pattern. This runs in
+        the worker processes, after grep_init().
+        Arguments:
+            task  : (filename, kind, start, end) from grep_tasks().
+        Returns a list of [(word, definition, [(start, end)])] for the
+        definitions with matches, in order.
+    """
+    filename, kind, start, end = task
+    if kind == 'db':
+        con = sqlite3.connect(filename)
         try:
-            results = spellchecker.check_word(word)
-        except spell.SpellChecker.ASpellError:
-            return None
-        else:
-            if results:
-                return results[word]
-    return None
+            definitions = con.execute(''.join((
+                'SELECT words.word, definitions.text FROM definitions ',
+                'JOIN words ON words.id == definitions.word_id ',
+                'WHERE definitions.rowid >= ? AND definitions.rowid < ? ',
+                'ORDER BY definitions.rowid;'
+            )), (start, end)).fetchall()
+        finally:
+            con.close()
+    else:
+        with open(filename, 'rb') as f:
+            f.seek(start)
+            data = f.read() if end is None else f.read(end - start)
+        definitions = iter_definitions(io.BytesIO(data))
+    found = []
+    for word, definition in definitions:
+        spans = [m.span() for m in grepregex.finditer(definition)]
+        if spans:
+            found.append((word, definition, spans))
+    return found
+
+
+def grep_init(pattern):
+    """ Compile the --grep pattern, once for each worker process. """
+    global grepregex
+    grepregex = re.compile(pattern)
+
+
+def grep_tasks(source):
+    """ Split a source into pieces of work for grep_chunk().
+        Databases are split into ranges of definitions, and text files are
+        split into ranges of bytes that start at a headword.
+        Returns a list of (filename, kind, start, end).
+        Raises EnvironmentError or sqlite3.Error if it can't be read.
+    """
+    if isinstance(source, DBSource):
+        try:
+            first, last = source.connect().execute(
+                'SELECT min(rowid), max(rowid) FROM definitions;').fetchone()
+        except (EnvironmentError, sqlite3.Error):
+            if source.fallback is None:
+                raise
+            return grep_tasks(source.fallback)
+        if first is None:
+            return []
+        return [
+            (source.filename, 'db', start, start + GREPROWS)
+            for start in range(first, last + 1, GREPROWS)
+        ]
+
+    starts = [0]
+    with open(source.filename, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        offset = GREPBYTES
+        while offset < size:
+            f.seek(offset)
+            # Skip the rest of this line, then look for the next headword.
+            f.readline()
+            while True:
+                start = f.tell()
+                line = f.readline()
+                if not line:
+                    start = None
+                    break
+                l = line.decode(DICTENCODING, 'replace').strip()
+                if l.startswith(ENDMARKERS):
+                    # Nothing after this is a definition.
+                    start = None
+                    break
+                if WORDPAT.match(l):
+                    break
+            if start is None:
+                break
+            starts.append(start)
+            offset = max(offset + GREPBYTES, start + 1)
+    ends = starts[1:] + [None]
+    return [
+        (source.filename, 'text', start, end)
+        for start, end in zip(starts, ends)
+    ]
+
+
+def headwords_first(found, word):
+    """ Returns the items of a {HEADWORD: results} dict from a source,
+        with the headword that matches `word` exactly first, followed by
+        the other spellings in order.
+    """
+    upperword = word.upper()
+    return sorted(found.items(), key=lambda item: item[0] != upperword)
+
+
+def http_server(dictionary, host, port, workers=HTTPWORKERS):
+    """ Create the server for --http, without starting it.
+        Call serve_forever() to start it, and server_close() when
+        finished. Use port 0 to pick any free port (see server_address).
+        Raises EnvironmentError if the address can't be used.
+    """
+    # http.server is slow to import, it is only needed for --http.
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+
+    class Server(PoolingMixIn, HTTPServer):
+        pass
+
+    class Handler(DefineRequestHandler, BaseHTTPRequestHandler):
+        pass
+
+    server = Server((host, port), Handler, workers=workers)
+    server.dictionary = dictionary
+    return server
+
+
+def index_sqlite_db(cursor):
+    """ Create the indexes used for lookups and completion.
+        This is done after all of the inserts, because it's faster that way.
+    """
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_words_word ON words(word);')
+    # Lookups go through the normalized keys, see word_key(). The word is
+    # included so the words table itself isn't read.
+    cursor.execute(''.join((
+        'CREATE INDEX IF NOT EXISTS idx_words_normalized ',
+        'ON words(normalized, word);'
+    )))
+    cursor.execute(''.join((
+        'CREATE INDEX IF NOT EXISTS idx_words_signature ',
+        'ON words(signature);'
+    )))
+    # Suffix searches are range queries on the reversed words.
+    cursor.execute(''.join((
+        'CREATE INDEX IF NOT EXISTS idx_words_reversed ',
+        'ON words(reversed);'
+    )))
+    cursor.execute(''.join((
+        'CREATE INDEX IF NOT EXISTS idx_definitions_word_id ',
+        'ON definitions(word_id);'
+    )))
+    cursor.execute(''.join((
+        'CREATE INDEX IF NOT EXISTS idx_senses_word_id ',
+        'ON senses(word_id, sense);'
+    )))
+    cursor.execute(''.join((
+        'CREATE INDEX IF NOT EXISTS idx_links_word_id ',
+        'ON links(word_id);'
+    )))
+    cursor.execute(''.join((
+        'CREATE INDEX IF NOT EXISTS idx_entries_word_id ',
+        'ON entries(word_id, entry);'
+    )))
+    # Listing words by part of speech is a range query on this.
+    cursor.execute(''.join((
+        'CREATE INDEX IF NOT EXISTS idx_entries_pos ',
+        'ON entries(pos, word);'
+    )))
 
 
 def insert_into_sqlite_db(cursor, word, definitions):
@@ -373,76 +1862,457 @@ def insert_into_sqlite_db(cursor, word, definitions):
             word        : Word to insert.
             definitions : Iterable of definitions for the word.
     """
-    cursor.execute('INSERT INTO words(word) values (?);', (word,))
+    cursor.execute(''.join((
+        'INSERT INTO words(word, signature, reversed, normalized) ',
+        'values (?, ?, ?, ?);'
+    )), (word, word_signature(word), word[::-1], word_key(word)))
     rowid = cursor.execute('SELECT max(id) from words;').fetchone()[0]
     if not rowid:
         print('Error! Rowid not set properly!: {}'.format(rowid))
         sys.exit(1)
 
-    for definition in definitions:
+    cursor.executemany(
+        'INSERT INTO trigrams(trigram, word_id) values (?, ?);',
+        ((trigram, rowid) for trigram in word_trigrams(word)))
+    cursor.executemany(
+        'INSERT INTO links(word_id, kind, target) values (?, ?, ?);',
+        ((rowid, kind, target) for kind, target in find_links(definitions)
+         if target != word))
+
+    for entry, definition in enumerate(definitions):
         cursor.execute(''.join((
             'INSERT INTO definitions(word_id, text) ',
             'values (?, ?);'
         )), (rowid, definition))
+        cursor.executemany(''.join((
+            'INSERT INTO senses(word_id, entry, sense, kind, text) ',
+            'values (?, ?, ?, ?, ?);'
+        )), (
+            (rowid, entry, sense, kind, text)
+            for sense, kind, text in split_senses(definition)
+        ))
+        cursor.execute(''.join((
+            'INSERT INTO entries(word_id, entry, word, pos, etym) ',
+            'values (?, ?, ?, ?, ?);'
+        )), (rowid, entry, word) + parse_header(definition))
         print('Set def for word_id: {}'.format(rowid))
 
 
+def iter_chunks(f, chunksize=CHUNKSIZE):
+    """ Read the dictionary file in large chunks, yielding pieces of text
+        that can be scanned on their own. Each piece starts with the line
+        break before its first line, so HEADWORDPAT finds every headword,
+        and lines are never split between pieces. Nothing is yielded after
+        an end marker (see find_endmarker()).
+        Arguments:
+            f          : An open file object, for the dictionary file.
+                         Binary mode is preferred, the file is read in
+                         large chunks and decoded all at once.
+            chunksize  : Number of bytes/characters to read at a time.
+    """
+    decode = codecs.getincrementaldecoder(DICTENCODING)('replace').decode
+    # The first line has no line break before it, so this is a fake one.
+    tail = '\n'
+    while True:
+        data = chunk = f.read(chunksize)
+        if isinstance(data, bytes):
+            # This may be empty when a character is split between reads.
+            chunk = decode(data, final=not data)
+        if data:
+            cut = chunk.rfind('\n')
+            if cut == -1:
+                # No complete line yet.
+                tail = ''.join((tail, chunk))
+                continue
+            text = ''.join((tail, chunk[:cut]))
+            # The last line may be incomplete, the next read finishes it.
+            tail = chunk[cut:]
+        else:
+            text = tail
+        end = find_endmarker(text)
+        if end is not None:
+            yield text[:end]
+            return
+        yield text
+        if not data:
+            return
+
+
 def iter_definitions(f):
     """ Iterate over the entire file, yielding ('word', 'definition').
-        This is not for searching.
+        This is not for searching, see iter_entries().
         Arguments:
             f  : An open file object, for the dictionary file.
+                 Binary mode is faster, see iter_chunks().
     """
-    # This is what the words look like in the file.
-    wordpat = re.compile('^[A-Z\-]+$')
-    # This is what the numbered list of defs look like.
-    listpat = re.compile('^[1-9]{1,3}\.')
-    # Start of a definition
-    defstart = 'Defn: '
-    defstartlen = len(defstart)
-    trimdefstart = lambda s: s[defstartlen:]
-    formatdefstart = lambda s: ''.join(('\n', trimdefstart(s)))
-    # Place holder for results.
-    currentword = None
-    deflines = None
+    for word, definition in iter_entries(f):
+        if definition:
+            yield word, definition
 
-    formatted_defs = lambda: '\n'.join(deflines).strip()
 
-    for line in f:
-        l = line.strip()
-        if not l:
-            # Blank line
-            continue
-        if l.startswith(('*** END', 'End of Project')):
-            # End of definitions.
-            return
+def iter_definitions_indb(cursor):
+    """ Iterate over an entire database, yielding ('word', 'definition')
+        in the order they were inserted. This is not for searching.
+        The query runs right away, so errors are raised by this call.
+        Arguments:
+            cursor  : sqlite3 connection cursor (sqlite3.connect(DICTDB)).
+    """
+    return cursor.execute(''.join((
+        'SELECT words.word, definitions.text FROM definitions ',
+        'JOIN words ON words.id == definitions.word_id ',
+        'ORDER BY definitions.rowid;'
+    )))
 
-        if wordpat.match(l):
-            if deflines and (deflines is not None):
-                # This is the next word.
-                yield currentword, formatted_defs()
-            # Start of a word.
-            currentword = l
-            deflines = []
-        else:
-            if deflines is None:
-                # Skip the header
-                continue
-            # This is part of a definition.
-            # If we have already added some lines,
-            # this is part of the current word's definition.
-            if listpat.match(l):
-                deflines.append('\n{}'.format(l))
+
+def iter_entries(f, words=None):
+    """ Iterate over the entire file, yielding ('WORD', 'definition') for
+        every headword, even when its definition is empty.
+        Each piece of the file is split at the headwords first, instead of
+        going line by line, and then each entry is formatted (see
+        format_lines()). With `words`, only the entries for those words
+        are formatted.
+        Arguments:
+            f      : An open file object, for the dictionary file.
+                     Binary mode is faster, see iter_chunks().
+            words  : A set of uppercase words to build definitions for.
+                     The definition is None for other words. The set may
+                     change while iterating, for words that are finished.
+                     Default: every word
+    """
+    currentword = None
+    # Pieces of the current word's text, or None when it isn't wanted.
+    pieces = None
+
+    def definition():
+        if pieces is None:
+            return None
+        return format_lines(''.join(pieces)).strip()
+
+    for text in iter_chunks(f):
+        pos = 0
+        for match in HEADWORDPAT.finditer(text):
+            if currentword is not None:
+                if pieces is not None:
+                    pieces.append(text[pos:match.start()])
+                yield currentword, definition()
+            # Start of a word. Anything before the first one is the header.
+            currentword = match.group(1)
+            if (words is None) or (currentword in words):
+                pieces = []
             else:
-                if l.startswith(defstart):
-                    # Beginning of definition.
-                    deflines.append(formatdefstart(l))
-                else:
-                    # Rest of the def.
-                    deflines.append(l)
+                pieces = None
+            pos = match.end()
+        if pieces is not None:
+            # The rest of this word is in the next piece.
+            pieces.append(text[pos:])
     # The last word in the file.
-    if deflines:
-        yield currentword, formatted_defs()
+    if currentword is not None:
+        yield currentword, definition()
+
+
+def iter_export(filename, fmt=None):
+    """ Lazily iterate over an exported dictionary, yielding
+        ('word', 'definition').
+        Only one record at a time is read into memory.
+        Arguments:
+            filename  : File name, made by convert_export().
+            fmt       : One of the EXPORTFORMATS.
+                        Default: guessed from the file extension.
+        Raises ValueError for unknown formats.
+    """
+    fmt = fmt or export_format(filename)
+    if fmt not in EXPORTFORMATS:
+        raise ValueError('Not an export format: {}'.format(fmt))
+    reader = EXPORTFORMATS[fmt][1]
+    with open(filename, 'rb', buffering=CHUNKSIZE) as f:
+        yield from reader(f)
+
+
+def iter_grep(sources, pattern, workers=1, limit=COMPLETELIMIT):
+    """ Search the definitions in several sources for a regular expression,
+        using a pool of worker processes. See grep_tasks().
+        Results are yielded in order, as soon as the pieces before them are
+        finished. Only a few pieces are queued ahead of the results, so
+        little work is wasted when the limit is reached.
+        Arguments:
+            sources  : DictSources to search, in order.
+            pattern  : Regular expression, as a str.
+            workers  : Number of processes. With 1, the search is done in
+                       this process.
+            limit    : Maximum number of definitions to yield.
+        Yields (source, word, definition, [(start, end)]).
+    """
+    tasks = []
+    for source in sources:
+        try:
+            tasks.extend((source, task) for task in grep_tasks(source))
+        except (EnvironmentError, sqlite3.Error) as ex:
+            print_source_error(source, ex)
+    if workers > 1:
+        # multiprocessing is slow to import, it is only needed here.
+        from concurrent.futures import ProcessPoolExecutor
+        executor = ProcessPoolExecutor(
+            max_workers=workers,
+            initializer=grep_init,
+            initargs=(pattern,))
+        submit = lambda task: executor.submit(grep_chunk, task).result
+    else:
+        executor = None
+        grep_init(pattern)
+        submit = lambda task: lambda: grep_chunk(task)
+    try:
+        taskiter = iter(tasks)
+        pending = deque(
+            (source, submit(task))
+            for source, task in itertools.islice(
+                taskiter, workers * GREPQUEUE))
+        found = 0
+        while pending:
+            source, result = pending.popleft()
+            for nextsource, task in itertools.islice(taskiter, 1):
+                pending.append((nextsource, submit(task)))
+            for word, definition, spans in result():
+                yield source, word, definition, spans
+                found += 1
+                if found >= limit:
+                    return
+    finally:
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+
+def iter_headwords(f):
+    """ Iterate over the headwords in the entire file, in order, with
+        duplicates. This only looks at the headword lines, so it is much
+        faster than iter_definitions().
+        Arguments:
+            f  : An open file object, for the dictionary file.
+    """
+    for text in iter_chunks(f):
+        yield from HEADWORDPAT.findall(text)
+
+
+def load_sources(dictfiles=None):
+    """ Build a list of DictSources to search, sorted by priority.
+        Webster's dictionary always comes first, followed by the
+        dictionaries in the DEFINE_DICTS environment variable,
+        and then `dictfiles`.
+        Arguments:
+            dictfiles  : Extra dictionary file names, with an optional
+                         priority ('glossary.sqlite3@10').
+    """
+    if os.path.exists(DICTDB):
+        sources = [
+            DBSource(
+                DICTDB,
+                name='websters',
+                fallback=TextSource(DICTFILE, name='websters'))
+        ]
+    else:
+        sources = [TextSource(DICTFILE, name='websters')]
+    envfiles = os.environ.get(DICTSVAR, '').split(os.pathsep)
+    for dictfile in envfiles + list(dictfiles or []):
+        if dictfile:
+            sources.append(DictSource.from_spec(dictfile))
+    # Higher priorities first, ties stay in the order they were given.
+    return sorted(sources, key=lambda source: -source.priority)
+
+
+def load_spellchecker():
+    """ Import spell.py and initialize a SpellChecker, only once.
+        This is deferred until it's needed, because finding aspell spawns
+        a process.
+        Returns the SpellChecker, or None if it's not available.
+    """
+    global spell, spellchecker, spellchecker_loaded
+    if spellchecker_loaded:
+        return spellchecker
+    spellchecker_loaded = True
+    try:
+        import spell
+    except ImportError:
+        # Spell checking will not be available. :(
+        spell = None
+        return None
+    # Suggestions are only remembered between runs when asked for.
+    if os.environ.get(SPELLCACHEVAR, '') in ('', '0'):
+        cachefile = None
+    else:
+        cachefile = spell.CACHEFILE
+    try:
+        spellchecker = spell.SpellChecker(cachefile=cachefile)
+    except spell.SpellChecker.NotSupported:
+        # ASpell is not available.
+        spell = None
+        spellchecker = None
+    return spellchecker
+
+
+def lookup_keys(words, normalized=True):
+    """ Returns the set of values to look up words by in a database,
+        their normalized keys (see word_key()) or their exact headwords.
+    """
+    if normalized:
+        return {word_key(w) for w in words}
+    return {w.upper() for w in words}
+
+
+def parse_address(address):
+    """ Parse a HOST:PORT address for --http. The host may be left out.
+        Returns a tuple of (host, port), or raises ValueError.
+    """
+    host, _, port = address.rpartition(':')
+    try:
+        port = int(port)
+    except ValueError:
+        raise ValueError('Invalid address, expecting HOST:PORT: {}'.format(
+            address))
+    return (host or 'localhost'), port
+
+
+def parse_complete_args(args):
+    """ Parse arguments for `--complete [PREFIX] [-n num]` without docopt.
+        Returns a tuple of (prefix, count).
+    """
+    prefix = count = None
+    args = list(args)
+    while args:
+        arg = args.pop(0)
+        if arg in ('-n', '--count'):
+            count = args.pop(0) if args else None
+        elif arg.startswith('--count='):
+            count = arg.partition('=')[-1]
+        elif prefix is None:
+            prefix = arg
+    return prefix, count
+
+
+# Color-coding for definitions.
+if OS.startswith('win'):
+    # No support for Windows, yet.
+    colorword = colordef = colorlist = colorsource = lambda s: s
+else:
+    colorword = lambda s: color(s, fore='green', style='bold')
+    colordef = lambda s: color(s, fore='blue')
+    colorlist = lambda s: color(s, fore='grey')
+    colorsource = lambda s: color(s, fore='yellow')
+
+
+def parse_count(count, default=COMPLETELIMIT):
+    """ Parse the --count option, or print an error and exit.
+        Returns `default` when no count was given.
+    """
+    try:
+        return int(count) if count else default
+    except ValueError:
+        print_fail('Invalid number for --count: {}'.format(count))
+
+
+def parse_header(definition):
+    """ Find the part of speech and etymology in the header of a definition
+        (from iter_definitions()), like "Abate, v. t. Etym: [OF. abatre.]".
+        Returns a tuple of (pos, etym), where pos is normalized by
+        pos_key() ('v'), and either may be None.
+    """
+    header = definition.partition('\n\n')[0]
+    posmatch = POSPAT.search(header)
+    etymmatch = ETYMPAT.search(header)
+    return (
+        pos_key(posmatch.group(1)) if posmatch else None,
+        ' '.join(etymmatch.group(1).split()) if etymmatch else None,
+    )
+
+
+def pos_key(pos):
+    """ Normalize a part of speech, from a definition header ('v. t.') or
+        the command line ('v', 'verb'), to the key that is stored ('v').
+    """
+    pos = pos.strip().lower()
+    pos = POSNAMES.get(pos, pos)
+    return pos.split('.')[0].strip()
+
+
+def preload_sources(sources, budget=None):
+    """ Load sources into memory (see MemorySource), while they fit in the
+        memory budget altogether. Sources that don't fit, or can't be
+        loaded, are searched on disk instead.
+        The memory used by each source is printed.
+        Arguments:
+            sources  : DictSources, from load_sources().
+            budget   : Memory budget in megabytes, for all of the sources.
+                       Default: PRELOADBUDGET
+        Returns a list of sources, in the same order.
+    """
+    try:
+        remaining = float(budget or PRELOADBUDGET) * 1024 * 1024
+    except ValueError:
+        print_fail('Invalid number for --budget: {}'.format(budget))
+    preloaded = []
+    for source in sources:
+        starttime = time.perf_counter()
+        try:
+            memsource = MemorySource(source, budget=remaining)
+        except (EnvironmentError, ValueError, sqlite3.Error) as ex:
+            print_error('Not preloading {}: {}'.format(source.name, ex))
+            preloaded.append(source)
+            continue
+        remaining -= memsource.size
+        print_status(
+            'Preloaded {}:'.format(source.name),
+            value='{:.1f} MB'.format(memsource.size / 1024 / 1024),
+            endmsg='({} words, {:.2f}s)'.format(
+                len(memsource.words),
+                time.perf_counter() - starttime))
+        preloaded.append(memsource)
+    return preloaded
+
+
+def print_completion_script(shell):
+    """ Print a completion script for `shell`, or an error if the shell
+        isn't supported.
+    """
+    try:
+        print(completion_script(shell))
+    except ValueError as ex:
+        print_error(str(ex))
+        return 1
+    return 0
+
+
+def print_corrections(words):
+    """ Prints suggested words in a colored block, in columns. """
+    # Get longest word, for formatting. (with room for a space)
+    longest = len(max(words, key=len)) + 1
+    # Make the rows fit within 80 chars (with a 4 space indent.)
+    rowcnt = max(76 // longest, 1)
+    for i in range(0, len(words), rowcnt):
+        print('    {}'.format(''.join(
+            colordef(w.ljust(longest)) for w in words[i:i + rowcnt]
+        )))
+
+
+def print_db_stats(stats):
+    """ Print the results of db_stats(). """
+    print_status('    Database:', value=stats['filename'])
+    print_status(
+        '    File size:',
+        value='{:.1f} MiB'.format(stats['size'] / (1024 * 1024)))
+    print_status(
+        '    Pages:',
+        value='{} x {} bytes, {} free'.format(
+            stats['page_count'],
+            stats['page_size'],
+            stats['freelist_count']))
+    print_status('    Schema version:', value=stats['user_version'] or '0')
+    print_status('    Rows:')
+    for table, count in stats['rows'].items():
+        print('        {}: {}'.format(colorword(table), colordef(str(count))))
+    print_status('    Indexes:', value='' if stats['indexes'] else 'none')
+    for name, table in stats['indexes'].items():
+        print('        {} on {}'.format(colorword(name), colordef(table)))
+    print_status('    Lookup query plan:')
+    for detail in stats['plan']:
+        print('        {}'.format(colordef(detail)))
 
 
 def print_error(msg):
@@ -464,6 +2334,33 @@ def print_fail(msg, exc=None, retcode=1):
     sys.exit(retcode)
 
 
+def print_related(
+        dictionary, words, depth=FOLLOWDEPTH, sense=None, pos=None):
+    """ Print the definitions for words that are linked to `words`,
+        following the links up to `depth` times. See Dictionary.related().
+        Only the `sense` and `pos` definitions are printed, like
+        find_definition() does.
+    """
+    related = dictionary.related(words, depth=depth)
+    senses = dictionary.lookup_senses(related, sense=sense, pos=pos)
+    for word, (kind, fromword) in related.items():
+        if not senses[word]:
+            # Not every word that is referred to has a definition.
+            continue
+        print_status(
+            '\n{}'.format(LINKLABELS.get(kind, kind)),
+            value=word.lower(),
+            endmsg='(from {})'.format(fromword.lower()))
+        print('\n{}'.format(format_senses(
+            senses[word],
+            labeled=len(dictionary.sources) > 1)))
+
+
+def print_source_error(source, exc):
+    """ Print an error message for a DictSource that failed. """
+    print_error('Unable to search {}: {}'.format(source.filename, exc))
+
+
 def print_status(lblormsg, value=None, endmsg=None):
     """ Print a colored status message.
         If no 'value' is passed, print a simple colored message.
@@ -478,6 +2375,1386 @@ def print_status(lblormsg, value=None, endmsg=None):
     print(msg)
 
 
+def rank_suggestions(word, suggestions):
+    """ Sort spelling suggestions for a word by how similar they are to
+        it, with the same trigram similarity that find_similar_indb()
+        uses. Ties keep the order they were suggested in.
+        Returns a list of suggestions, best first, without duplicates.
+    """
+    trigrams = word_trigrams(word)
+
+    def similarity(suggestion):
+        other = word_trigrams(suggestion)
+        return len(trigrams & other) / len(trigrams | other)
+
+    unique = list(OrderedDict.fromkeys(suggestions))
+    return sorted(unique, key=similarity, reverse=True)
+
+
+def read_ndjson(f):
+    """ Read ('word', 'definition') records written by write_ndjson(). """
+    for line in f:
+        if line.strip():
+            record = json.loads(line.decode('utf-8'))
+            yield record['word'], record['definition']
+
+
+def read_records(f):
+    """ Read ('word', 'definition') records written by write_records().
+        Raises ValueError if the file wasn't made by write_records().
+    """
+    if f.read(len(RECORDMAGIC)) != RECORDMAGIC:
+        raise ValueError('Not a definition record file.')
+    headerlen = RECORDHEADER.size
+    while True:
+        header = f.read(headerlen)
+        if not header:
+            return
+        if len(header) < headerlen:
+            raise ValueError('Truncated definition record file.')
+        wordlen, deflen = RECORDHEADER.unpack(header)
+        data = f.read(wordlen + deflen)
+        if len(data) < (wordlen + deflen):
+            raise ValueError('Truncated definition record file.')
+        yield (
+            data[:wordlen].decode('utf-8'),
+            data[wordlen:].decode('utf-8'))
+
+
+def read_tsv(f):
+    """ Read ('word', 'definition') records written by write_tsv(). """
+    unescape = lambda s: TSVUNESCAPEPAT.sub(
+        lambda m: TSVUNESCAPES.get(m.group(1), m.group(1)),
+        s)
+    for line in f:
+        line = line.decode('utf-8').rstrip('\n')
+        if line:
+            word, _, definition = line.partition('\t')
+            yield unescape(word), unescape(definition)
+
+
+def request_waiting(handler):
+    """ Returns True if the next request on a kept-alive connection (from
+        a socketserver.StreamRequestHandler) has already started to
+        arrive. It may be in the handler's read buffer already, where a
+        selector wouldn't see it.
+    """
+    connection = handler.connection
+    timeout = connection.gettimeout()
+    connection.setblocking(False)
+    try:
+        return bool(handler.rfile.peek(1))
+    except EnvironmentError:
+        # Let the handler find out what's wrong with it.
+        return True
+    finally:
+        connection.settimeout(timeout)
+
+
+def rhyme_key(word):
+    """ Returns the part of a word that rhymes, like 'ION' for
+        'station': the last vowels, and the letters after them.
+        A final E after a consonant is silent, so the vowels before it
+        are used too, like 'AKE' for 'cake' and 'APPLE' for 'apple'.
+        Words that rhyme have the same key (by spelling, at least).
+    """
+    word = word.upper()
+    match = RHYMEPAT.search(word)
+    return match.group() if match else word
+
+
+def root_word(word):
+    """ Guess the root word for a word, like 'slay' instead of 'slayed'.
+        Returns None if there is no suffix to remove.
+    """
+    if word.endswith(('ed', 'er', 'es')):
+        return word[:-2]
+    elif word.endswith(('ing', 'ify', 'ize')):
+        return word[:-3]
+    return None
+
+
+def root_words(word):
+    """ Returns a list of root words that find_definition() may try for a
+        word, in the order they would be tried.
+    """
+    roots = []
+    # find_definition() only tries two more times after the first attempt.
+    while len(roots) < 2:
+        word = root_word(word)
+        if not word:
+            break
+        roots.append(word)
+    return roots
+
+
+def senses_query(count, sense=None, pos=None, normalized=True):
+    """ Returns the query that find_senses_indb() uses for `count` words.
+        If `sense` or `pos` are not None, the query has a parameter for
+        each of them, in that order. See entries_query() for `normalized`.
+    """
+    return ''.join((
+        'SELECT words.word, senses.entry, senses.sense, senses.kind, ',
+        'senses.text FROM words JOIN senses ',
+        'ON senses.word_id == words.id ',
+        '' if pos is None else ''.join((
+            'JOIN entries ON entries.word_id == senses.word_id ',
+            'AND entries.entry == senses.entry ',
+        )),
+        'WHERE words.{} IN ({}) '.format(
+            'normalized' if normalized else 'word',
+            ', '.join('?' * count)),
+        '' if sense is None else 'AND senses.sense IN (0, ?) ',
+        # The unary + keeps SQLite from scanning every entry for the part
+        # of speech, instead of looking up the entries for the words.
+        '' if pos is None else 'AND +entries.pos == ? ',
+        'ORDER BY senses.rowid;'
+    ))
+
+
+def split_senses(definition):
+    """ Split a definition (from iter_definitions()) into its parts:
+        the header, with the part of speech and etymology, then each
+        sense. Senses are numbered in order, or by their number when
+        they are a numbered list.
+        Returns a list of [(sense, kind, text)], where sense is 0 for the
+        header, and kind is SENSE_HEAD, SENSE_LIST, or SENSE_DEFN.
+    """
+    senses = []
+    number = 0
+    # iter_definitions() puts a blank line before each sense.
+    for i, text in enumerate(definition.split('\n\n')):
+        listmatch = LISTPAT.match(text)
+        if listmatch:
+            number = int(listmatch.group()[:-1])
+            senses.append((number, SENSE_LIST, text))
+        elif i == 0:
+            senses.append((0, SENSE_HEAD, text))
+        else:
+            number += 1
+            senses.append((number, SENSE_DEFN, text))
+    return senses
+
+
+def sub_signatures(signature):
+    """ Returns every signature that can be made with some of the letters
+        in `signature`, with at least ANAGRAMMIN letters, longest first.
+        Raises ValueError when there are more than ANAGRAMMAX letters.
+    """
+    if len(signature) > ANAGRAMMAX:
+        raise ValueError('Too many letters to find sub-anagrams: {}'.format(
+            len(signature)))
+    letters = sorted(Counter(signature).items())
+    signatures = [
+        ''.join(letter * n for (letter, _), n in zip(letters, counts))
+        for counts in itertools.product(
+            *(range(count + 1) for _, count in letters))
+        if sum(counts) >= ANAGRAMMIN
+    ]
+    return sorted(signatures, key=len, reverse=True)
+
+
+def word_key(word):
+    """ Normalize a word for lookups, so 'today', 'To-day', and 'TODAY'
+        are the same. Case is folded, hyphens and apostrophes are removed,
+        and accents are stripped ('Café' -> 'cafe').
+    """
+    if not word.isascii():
+        word = ''.join(
+            c for c in unicodedata.normalize('NFKD', word)
+            if not unicodedata.combining(c))
+    return word.casefold().translate(KEYDROP)
+
+
+def word_signature(word):
+    """ Returns the sorted letters of a word, like 'ELPPA' for 'apple'.
+        Anagrams have the same signature.
+    """
+    return ''.join(sorted(c for c in word.upper() if 'A' <= c <= 'Z'))
+
+
+def word_trigrams(word):
+    """ Returns a set of trigrams for a word, like {'$AP', 'APP', ..}.
+        The word is padded, so the start and end of the word count more.
+    """
+    padded = '${}$'.format(word.upper())
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def write_ndjson(definitions, fout):
+    """ Write ('word', 'definition') pairs as newline-delimited JSON,
+        one {"word": .., "definition": ..} object per line.
+        Returns the number of definitions written.
+    """
+    count = 0
+    for count, (word, definition) in enumerate(definitions, start=1):
+        record = {'word': word, 'definition': definition}
+        fout.write(json.dumps(record, ensure_ascii=False).encode('utf-8'))
+        fout.write(b'\n')
+    return count
+
+
+def write_records(definitions, fout):
+    """ Write ('word', 'definition') pairs as length-prefixed records.
+        The file starts with RECORDMAGIC, and each record is the byte
+        length of the word and definition (RECORDHEADER), followed by the
+        UTF-8 word and definition.
+        Returns the number of definitions written.
+    """
+    fout.write(RECORDMAGIC)
+    count = 0
+    for count, (word, definition) in enumerate(definitions, start=1):
+        wordbytes = word.encode('utf-8')
+        defbytes = definition.encode('utf-8')
+        fout.write(RECORDHEADER.pack(len(wordbytes), len(defbytes)))
+        fout.write(wordbytes)
+        fout.write(defbytes)
+    return count
+
+
+def write_tsv(definitions, fout):
+    """ Write ('word', 'definition') pairs as tab-separated lines.
+        Backslashes, tabs, and newlines are escaped.
+        Returns the number of definitions written.
+    """
+    escape = lambda s: s.translate(TSVESCAPES)
+    count = 0
+    for count, (word, definition) in enumerate(definitions, start=1):
+        fout.write('{}\t{}\n'.format(
+            escape(word),
+            escape(definition)).encode('utf-8'))
+    return count
+
+
+# Export formats for convert_export() and iter_export(),
+# {name: (writer, reader)}.
+EXPORTFORMATS = {
+    'ndjson': (write_ndjson, read_ndjson),
+    'records': (write_records, read_records),
+    'tsv': (write_tsv, read_tsv),
+}
+# Export formats by file extension.
+EXPORTEXTS = {
+    '.jsonl': 'ndjson',
+    '.ndjson': 'ndjson',
+    '.rec': 'records',
+    '.tsv': 'tsv',
+}
+# Start of a length-prefixed record file.
+RECORDMAGIC = b'DEFINE-RECORDS-1\n'
+# Each record starts with the word length, and definition length.
+RECORDHEADER = struct.Struct('>II')
+# Escapes for the tsv format.
+TSVESCAPES = str.maketrans({'\\': '\\\\', '\t': '\\t', '\n': '\\n'})
+TSVUNESCAPES = {'t': '\t', 'n': '\n'}
+TSVUNESCAPEPAT = re.compile(r'\\(.)')
+
+
+class DictSource(object):
+
+    """ A dictionary to search, with a name for labeling results, and a
+        priority for ordering them.
+        Use DictSource.from_spec() to pick the right type of source
+        for a file.
+        Sources may be searched from several threads at once.
+    """
+
+    def __init__(self, filename, name=None, priority=0):
+        self.filename = filename
+        self.name = name or os.path.splitext(os.path.split(filename)[1])[0]
+        self.priority = priority
+
+    def __repr__(self):
+        return '{}({!r}, name={!r}, priority={!r})'.format(
+            type(self).__name__,
+            self.filename,
+            self.name,
+            self.priority)
+
+    def close(self):
+        """ Release any resources held by this source. """
+        pass
+
+    def find_anagrams(self, word, sub=False):
+        """ Find the anagrams of a word, see Dictionary.anagrams().
+            Returns a list of uppercase words.
+        """
+        return []
+
+    def find_entries(self, words):
+        """ Find several words at once.
+            Returns a dict of {WORD: [definition]} for the words found.
+        """
+        raise NotImplementedError('Sources must implement find_entries().')
+
+    def find_existing(self, words):
+        """ Find out which words are in this source.
+            Returns a set of the uppercase words that were found.
+        """
+        return set(self.find_entries(words))
+
+    def find_links(self, words):
+        """ Find the words that several words refer to, see find_links().
+            Returns a dict of {WORD: [(kind, WORD)]} for the words that
+            have links.
+        """
+        found = OrderedDict()
+        for word, definitions in self.find_entries(words).items():
+            links = [
+                (kind, target) for kind, target in find_links(definitions)
+                if target != word
+            ]
+            if links:
+                found[word] = links
+        return found
+
+    def find_suffix(self, suffix, limit=COMPLETELIMIT):
+        """ Find words ending with an uppercase suffix.
+            Returns a list of up to `limit` uppercase words, sorted by
+            their endings.
+        """
+        return []
+
+    def find_senses(self, words, sense=None, pos=None):
+        """ Find the senses for several words at once, see split_senses().
+            If `sense` is given, only that numbered sense and the headers
+            are found. If `pos` is given, only the definitions for that
+            part of speech are found.
+            Returns a dict of {WORD: [(entry, sense, kind, text)]} for the
+            words found.
+        """
+        found = OrderedDict()
+        for word, definitions in self.find_entries(words).items():
+            senses = [
+                (entry, number, kind, text)
+                for entry, definition in enumerate(definitions)
+                if (pos is None) or (parse_header(definition)[0] == pos)
+                for number, kind, text in split_senses(definition)
+                if (sense is None) or (number in (0, sense))
+            ]
+            if senses:
+                found[word] = senses
+        return found
+
+    def find_similar(self, word, limit=FUZZYLIMIT):
+        """ Find words that are spelled like `word`.
+            Returns a list of [('word', similarity)], best matches first.
+        """
+        return []
+
+    def find_words(self, prefix, pos=None, limit=COMPLETELIMIT):
+        """ Find words starting with an uppercase prefix, and with a
+            definition for the part of speech `pos` when it is given.
+            Returns a list of up to `limit` uppercase words, sorted.
+        """
+        return []
+
+    @staticmethod
+    def from_spec(spec):
+        """ Create a source from a file name with an optional priority,
+            like 'glossary.sqlite3' or 'glossary.sqlite3@10'.
+            The type of source depends on the file extension.
+            Raises ValueError for a bad priority.
+        """
+        filename, _, priority = spec.rpartition(PRIORITYSEP)
+        if filename and priority.lstrip('-').isdigit():
+            priority = int(priority)
+        else:
+            # No priority, or it's part of the path ('me@host/dict.txt').
+            filename, priority = spec, 0
+        ext = os.path.splitext(filename)[1].lower()
+        sourcetype = SOURCETYPES.get(ext, TextSource)
+        return sourcetype(filename, priority=priority)
+
+
+class DBSource(DictSource):
+
+    """ An SQLite database source, like the one made by `define -c`.
+        Each thread gets its own connection, which is kept open until
+        close() is called.
+    """
+
+    def __init__(self, filename, name=None, priority=0, fallback=None):
+        """ If a `fallback` source is given, it is used when the database
+            can't be searched.
+        """
+        super().__init__(filename, name=name, priority=priority)
+        self.fallback = fallback
+        # Whether the database has normalized keys, see keyed().
+        self.haskeys = None
+        self.local = threading.local()
+        # All open connections, so close() can close them.
+        self.connections = []
+        self.lock = threading.Lock()
+
+    def close(self):
+        """ Close the connections for all threads. """
+        with self.lock:
+            connections, self.connections = self.connections, []
+            self.local = threading.local()
+        for con in connections:
+            con.close()
+        if self.fallback is not None:
+            self.fallback.close()
+
+    def connect(self):
+        """ Returns the connection for this thread, opening it if needed.
+            Raises FileNotFoundError if the database doesn't exist.
+        """
+        con = getattr(self.local, 'con', None)
+        if con is not None:
+            return con
+        if not os.path.exists(self.filename):
+            # sqlite3.connect() would create an empty database.
+            raise FileNotFoundError('No such file: {}'.format(self.filename))
+        # Only this thread uses it, but close() may be called from another.
+        con = sqlite3.connect(self.filename, check_same_thread=False)
+        with self.lock:
+            self.local.con = con
+            self.connections.append(con)
+        return con
+
+    def find_anagrams(self, word, sub=False):
+        try:
+            return find_anagrams_indb(self.connect().cursor(), word, sub=sub)
+        except sqlite3.Error:
+            # Older databases don't have signatures.
+            pass
+        except EnvironmentError:
+            if self.fallback is None:
+                raise
+            return self.fallback.find_anagrams(word, sub=sub)
+        matches = anagram_matcher(word, sub=sub)
+        rows = self.connect().cursor().execute('SELECT word FROM words;')
+        return [row[0] for row in rows if matches(row[0])]
+
+    def find_entries(self, words):
+        try:
+            return find_entries_indb(
+                self.connect().cursor(),
+                words,
+                normalized=self.keyed())
+        except (EnvironmentError, sqlite3.Error):
+            if self.fallback is None:
+                raise
+        return self.fallback.find_entries(words)
+
+    def find_existing(self, words):
+        try:
+            return find_existing_indb(
+                self.connect().cursor(),
+                words,
+                normalized=self.keyed())
+        except (EnvironmentError, sqlite3.Error):
+            if self.fallback is None:
+                raise
+        return self.fallback.find_existing(words)
+
+    def find_links(self, words):
+        try:
+            return find_links_indb(
+                self.connect().cursor(),
+                words,
+                normalized=self.keyed())
+        except sqlite3.Error:
+            # Older databases don't have links, they are found here.
+            pass
+        except EnvironmentError:
+            if self.fallback is None:
+                raise
+            return self.fallback.find_links(words)
+        return super().find_links(words)
+
+    def find_senses(self, words, sense=None, pos=None):
+        try:
+            return find_senses_indb(
+                self.connect().cursor(),
+                words,
+                sense,
+                pos,
+                normalized=self.keyed())
+        except sqlite3.Error:
+            # Older databases don't have senses or entries, they are
+            # split here.
+            pass
+        except EnvironmentError:
+            if self.fallback is None:
+                raise
+            return self.fallback.find_senses(words, sense=sense, pos=pos)
+        return super().find_senses(words, sense=sense, pos=pos)
+
+    def find_suffix(self, suffix, limit=COMPLETELIMIT):
+        try:
+            return find_suffix_indb(self.connect().cursor(), suffix, limit)
+        except sqlite3.Error:
+            # Older databases don't have reversed words.
+            pass
+        except EnvironmentError:
+            if self.fallback is None:
+                raise
+            return self.fallback.find_suffix(suffix, limit=limit)
+        rows = self.connect().cursor().execute('SELECT word FROM words;')
+        words = {row[0] for row in rows if row[0].endswith(suffix)}
+        return sorted(words, key=lambda w: w[::-1])[:limit]
+
+    def find_similar(self, word, limit=FUZZYLIMIT):
+        try:
+            return find_similar_indb(self.connect().cursor(), word, limit)
+        except sqlite3.Error:
+            # Older databases don't have trigrams.
+            return []
+
+    def keyed(self):
+        """ Returns True if the database has normalized keys for lookups
+            (see word_key()). Older databases only find exact headwords.
+        """
+        if self.haskeys is None:
+            columns = self.connect().execute('PRAGMA table_info(words);')
+            self.haskeys = 'normalized' in {row[1] for row in columns}
+        return self.haskeys
+
+    def find_words(self, prefix, pos=None, limit=COMPLETELIMIT):
+        try:
+            cursor = self.connect().cursor()
+            if pos is None:
+                words = complete_word_indb(cursor, prefix, limit=limit)
+                return [w.upper() for w in words]
+            return find_words_indb(cursor, prefix, pos, limit=limit)
+        except sqlite3.Error:
+            # Older databases don't have entries.
+            pass
+        except EnvironmentError:
+            if self.fallback is None:
+                raise
+            return self.fallback.find_words(prefix, pos=pos, limit=limit)
+        cursor = self.connect().cursor()
+        found = self.find_senses(
+            complete_word_indb(cursor, prefix, limit=-1),
+            sense=0,
+            pos=pos)
+        return sorted(found)[:limit]
+
+
+class TextSource(DictSource):
+
+    """ A plain text source, in the same format as Webster's. """
+
+    def find_anagrams(self, word, sub=False):
+        with open(self.filename, 'rb') as f:
+            return find_anagrams_infile(f, word, sub=sub)
+
+    def find_entries(self, words):
+        with open(self.filename, 'rb') as f:
+            return find_entries_infile(f, words)
+
+    def find_suffix(self, suffix, limit=COMPLETELIMIT):
+        with open(self.filename, 'rb') as f:
+            return find_suffix_infile(f, suffix, limit=limit)
+
+    def find_words(self, prefix, pos=None, limit=COMPLETELIMIT):
+        with open(self.filename, 'rb') as f:
+            return find_words_infile(f, prefix, pos=pos, limit=limit)
+
+
+class MemorySource(DictSource):
+
+    """ A source that is loaded into memory from another source, for
+        many lookups.
+        The headwords are kept as a sorted list of interned strings, and
+        the definitions are kept in a single UTF-8 buffer with arrays of
+        offsets, so the whole dictionary is a few large objects instead of
+        a few objects for every definition.
+    """
+
+    def __init__(self, source, budget=None):
+        """ Load everything from `source`, a DBSource or TextSource.
+            Similar words are still found with `source`.
+            Raises ValueError if it would need more than `budget` bytes,
+            or EnvironmentError/sqlite3.Error if `source` can't be read.
+        """
+        super().__init__(
+            source.filename,
+            name=source.name,
+            priority=source.priority)
+        self.source = source
+        buf = bytearray()
+        # Offsets of each definition in the buffer, with the end last.
+        offsets = array('Q', [0])
+        # The headword of each definition, in the order they were read.
+        defwords = []
+        wordsize = {}
+        for word, definition in self.iter_source(source):
+            buf.extend(definition.encode(DICTENCODING))
+            offsets.append(len(buf))
+            if word not in wordsize:
+                word = sys.intern(word)
+                # The string, and its place in self.words.
+                wordsize[word] = sys.getsizeof(word) + 8
+            defwords.append(word)
+            if (budget is not None) and (len(buf) > budget):
+                raise ValueError(
+                    'It needs more than the memory budget, {:.1f} MB.'.format(
+                        budget / 1024 / 1024))
+        self.buf = bytes(buf)
+        del buf
+        self.view = memoryview(self.buf)
+        self.offsets = offsets
+        # Definition numbers, grouped by headword in sorted order.
+        # The sort is stable, so each word's definitions stay in order.
+        self.order = array(
+            'L',
+            sorted(range(len(defwords)), key=defwords.__getitem__))
+        self.words = sorted(wordsize)
+        # Where each headword's definitions start in self.order, with the
+        # end last.
+        self.starts = array('L', [0])
+        for _, group in itertools.groupby(
+                self.order, key=defwords.__getitem__):
+            self.starts.append(self.starts[-1] + sum(1 for _ in group))
+        del defwords
+        # Headword numbers, sorted by the reversed words for suffixes.
+        self.suffixes = array(
+            'L',
+            sorted(range(len(self.words)), key=lambda i: self.words[i][::-1]))
+        # Headword numbers, sorted by their normalized keys for lookups.
+        self.keys = array(
+            'L',
+            sorted(range(len(self.words)), key=lambda i: self.key(i)))
+        self.size = sum((
+            sys.getsizeof(self.buf),
+            sys.getsizeof(self.words),
+            sum(wordsize.values()),
+            sum(
+                a.itemsize * len(a)
+                for a in (
+                    self.offsets, self.order, self.starts, self.suffixes,
+                    self.keys)
+            ),
+        ))
+        if (budget is not None) and (self.size > budget):
+            raise ValueError(
+                'It needs {:.1f} MB, more than the memory budget.'.format(
+                    self.size / 1024 / 1024))
+
+    def close(self):
+        self.source.close()
+
+    def definitions(self, index):
+        """ Returns the definitions for a headword number. """
+        return [
+            str(
+                self.view[self.offsets[n]:self.offsets[n + 1]],
+                DICTENCODING)
+            for n in self.order[self.starts[index]:self.starts[index + 1]]
+        ]
+
+    def find_anagrams(self, word, sub=False):
+        matches = anagram_matcher(word, sub=sub)
+        return [w for w in self.words if matches(w)]
+
+    def find_entries(self, words):
+        found = OrderedDict()
+        for key in sorted({word_key(w) for w in words}):
+            for index in self.lookup(key):
+                found[self.words[index]] = self.definitions(index)
+        return found
+
+    def find_existing(self, words):
+        return {
+            self.words[index]
+            for key in {word_key(w) for w in words}
+            for index in self.lookup(key)
+        }
+
+    def find_similar(self, word, limit=FUZZYLIMIT):
+        return self.source.find_similar(word, limit=limit)
+
+    def find_suffix(self, suffix, limit=COMPLETELIMIT):
+        lo = bisect_key(
+            self.suffixes,
+            suffix[::-1],
+            key=lambda i: self.words[i][::-1])
+        found = []
+        for index in self.suffixes[lo:lo + limit]:
+            word = self.words[index]
+            if not word.endswith(suffix):
+                break
+            found.append(word)
+        return found
+
+    def find_words(self, prefix, pos=None, limit=COMPLETELIMIT):
+        found = []
+        for index in range(bisect_left(self.words, prefix), len(self.words)):
+            word = self.words[index]
+            if (len(found) == limit) or not word.startswith(prefix):
+                break
+            if (pos is None) or any(
+                    parse_header(d)[0] == pos
+                    for d in self.definitions(index)):
+                found.append(word)
+        return found
+
+    def key(self, index):
+        """ Returns the normalized key for a headword number. """
+        return word_key(self.words[index])
+
+    def lookup(self, key):
+        """ Returns the headword numbers for a normalized key, in order.
+        """
+        found = []
+        start = bisect_key(self.keys, key, key=self.key)
+        for index in self.keys[start:]:
+            if self.key(index) != key:
+                break
+            found.append(index)
+        return sorted(found)
+
+    @staticmethod
+    def iter_source(source):
+        """ Iterate over every ('word', 'definition') in a source,
+            using the fallback text file if a database can't be read.
+        """
+        if isinstance(source, DBSource):
+            try:
+                rows = iter_definitions_indb(source.connect().cursor())
+            except (EnvironmentError, sqlite3.Error):
+                if source.fallback is None:
+                    raise
+                source = source.fallback
+            else:
+                yield from rows
+                return
+        with open(source.filename, 'rb') as f:
+            yield from iter_definitions(f)
+
+
+SOURCETYPES = {
+    '.db': DBSource,
+    '.sqlite': DBSource,
+    '.sqlite3': DBSource,
+}
+
+
+class Dictionary(object):
+
+    """ Looks up words without printing anything, for using define.py as a
+        library. One Dictionary can be shared between threads.
+        Definitions are returned as lists of Definition tuples,
+        (word, source name, text), in source priority order.
+        Use it as a context manager, or call close() when finished.
+    """
+
+    def __init__(self, sources=None, onerror=None, spelling=True):
+        """ Arguments:
+                sources   : A list of DictSources, sorted by priority.
+                            Default: load_sources()
+                onerror   : A function to call with (source, exception)
+                            when a source fails. Failed sources are
+                            skipped.
+                spelling  : Whether suggest() may use ASpell when there
+                            are no similar words in the sources.
+        """
+        self.sources = load_sources() if sources is None else list(sources)
+        self.onerror = onerror
+        self.spelling = spelling
+        self.executor = None
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type_, value, traceback):
+        self.close()
+        return False
+
+    def anagrams(self, word, sub=False, limit=COMPLETELIMIT):
+        """ Find the words that are anagrams of `word`, not including
+            the word itself. With `sub`, words that use some of the
+            letters are found too (longest first).
+            Raises ValueError if `word` is too long for `sub`, see
+            ANAGRAMMAX.
+            Returns a list of up to `limit` uppercase words.
+        """
+        letters = len(word_signature(word))
+        if sub and (letters > ANAGRAMMAX):
+            raise ValueError(
+                'Too many letters to find sub-anagrams: {}'.format(letters))
+        found = {word.upper()}
+        anagrams = []
+        for _, sourcefound in self.query('find_anagrams', word, sub):
+            for anagram in sourcefound:
+                if anagram not in found:
+                    found.add(anagram)
+                    anagrams.append(anagram)
+        anagrams.sort(key=lambda w: (-len(word_signature(w)), w))
+        return anagrams[:limit]
+
+    def close(self):
+        """ Stop the worker threads, and close all sources. """
+        with self.lock:
+            executor, self.executor = self.executor, None
+        if executor is not None:
+            executor.shutdown(wait=True)
+        for source in self.sources:
+            source.close()
+
+    def ends_with(self, suffix, limit=COMPLETELIMIT):
+        """ Find the words ending with `suffix`, with an index range query
+            when possible.
+            Returns a list of up to `limit` uppercase words, sorted by
+            their endings, so words that rhyme are together.
+        """
+        suffix = suffix.upper()
+        if not suffix:
+            return []
+        words = set()
+        for _, found in self.query('find_suffix', suffix, limit):
+            words.update(found)
+        return sorted(words, key=lambda w: w[::-1])[:limit]
+
+    def exists(self, word):
+        """ Returns True if the word is in any of the sources. """
+        return bool(self.existing((word,)))
+
+    def existing(self, words):
+        """ Find out which words are in any of the sources, with one query
+            per source.
+            Returns a set of the words (as given) that were found.
+        """
+        words = list(words)
+        found = set()
+        for _, sourcefound in self.query('find_existing', words):
+            found.update(word_key(w) for w in sourcefound)
+        return {w for w in words if word_key(w) in found}
+
+    def lookup(self, word):
+        """ Find the definitions for a word.
+            Returns a list of Definitions, or [] if the word isn't found.
+        """
+        return self.lookup_many((word,))[word]
+
+    def lookup_many(self, words):
+        """ Find the definitions for several words, with one search per
+            source. The sources are searched at the same time.
+            Words are matched by their normalized keys (see word_key())
+            when the source has them, so 'to-day' also finds 'TODAY'.
+            Returns a dict of {word: [Definition]}, with an entry for every
+            word (as given) even when it isn't found.
+        """
+        words = list(words)
+        results = self.query('find_entries', words)
+        found = {}
+        for word in words:
+            key = word_key(word)
+            found[word] = [
+                Definition(headword, source.name, text)
+                for source, entries in results
+                for headword, texts in headwords_first(entries, word)
+                if word_key(headword) == key
+                for text in texts
+            ]
+        return found
+
+    def lookup_senses(self, words, sense=None, pos=None):
+        """ Find the definitions for several words, split into senses
+            (see split_senses()). The sources are searched at the same
+            time.
+            If `sense` is given, only that numbered sense and the header
+            of each definition are found. If `pos` is given (see
+            pos_key()), only the definitions for that part of speech
+            are found.
+            Words are matched like lookup_many() does.
+            Returns a dict of {word: [Sense]}, with an entry for every
+            word (as given) even when it isn't found.
+        """
+        words = list(words)
+        results = self.query('find_senses', words, sense, pos)
+        found = {}
+        for word in words:
+            key = word_key(word)
+            found[word] = [
+                Sense(headword, source.name, *row)
+                for source, senses in results
+                for headword, rows in headwords_first(senses, word)
+                if word_key(headword) == key
+                for row in rows
+            ]
+        return found
+
+    def query(self, methodname, *args):
+        """ Call a DictSource method on every source, at the same time when
+            there is more than one.
+            Returns a list of [(source, result)] in priority order,
+            without the sources that failed.
+        """
+        if len(self.sources) == 1:
+            source = self.sources[0]
+            calls = [(source, lambda: getattr(source, methodname)(*args))]
+        else:
+            executor = self.get_executor()
+            calls = [
+                (source, executor.submit(getattr(source, methodname), *args))
+                for source in self.sources
+            ]
+            calls = [(source, future.result) for source, future in calls]
+        results = []
+        for source, call in calls:
+            try:
+                results.append((source, call()))
+            except (EnvironmentError, sqlite3.Error) as ex:
+                if self.onerror is not None:
+                    self.onerror(source, ex)
+        return results
+
+    def get_executor(self):
+        """ Returns the thread pool for searching sources, starting it if
+            needed.
+        """
+        with self.lock:
+            if self.executor is None:
+                # concurrent.futures imports logging, which is slow. Only
+                # lookups in several sources need it.
+                from concurrent.futures import ThreadPoolExecutor
+                self.executor = ThreadPoolExecutor(
+                    max_workers=len(self.sources) * SOURCETHREADS)
+            return self.executor
+
+    def related(self, words, depth=FOLLOWDEPTH):
+        """ Find the words that are linked to `words` (see find_links()),
+            and the words linked to those, up to `depth` links away.
+            Each step is one query per source, for all of the words found
+            in the step before. Words are matched like lookup_many() does,
+            and are only visited once, whatever their spelling.
+            Returns an OrderedDict of {WORD: (kind, FROMWORD)}, nearest
+            words first, without `words` themselves.
+        """
+        step = list(OrderedDict.fromkeys(w.upper() for w in words))
+        seen = {word_key(w) for w in step}
+        related = OrderedDict()
+        for _ in range(depth):
+            nextstep = []
+            for _, links in self.query('find_links', step):
+                for word, wordlinks in links.items():
+                    for kind, target in wordlinks:
+                        key = word_key(target)
+                        if key in seen:
+                            continue
+                        seen.add(key)
+                        related[target] = (kind, word)
+                        nextstep.append(target)
+            if not nextstep:
+                break
+            step = nextstep
+        return related
+
+    def rhymes(self, word, limit=COMPLETELIMIT):
+        """ Find the words that rhyme with `word`, by spelling. They have
+            the same rhyme_key().
+            Returns a list of up to `limit` uppercase words, not including
+            the word itself.
+        """
+        word = word.upper()
+        key = rhyme_key(word)
+        # Words ending with 'AT' include 'BOAT', which has the key 'OAT'.
+        rhymes = [
+            w for w in self.ends_with(key, limit=RHYMECANDIDATES)
+            if (w != word) and (rhyme_key(w) == key)
+        ]
+        return rhymes[:limit]
+
+    def similar(self, word, limit=FUZZYLIMIT):
+        """ Find words in the sources that are spelled like `word`.
+            Returns a list of [('word', similarity)], best matches first.
+        """
+        best = {}
+        for _, similar in self.query('find_similar', word, limit):
+            for similarword, score in similar:
+                best[similarword] = max(score, best.get(similarword, 0))
+        ranked = sorted(
+            best.items(),
+            key=lambda ws: (-ws[1], abs(len(ws[0]) - len(word)), ws[0]))
+        return ranked[:limit]
+
+    def suggest(self, word, limit=FUZZYLIMIT):
+        """ Get spelling suggestions for a word.
+            Similar words from the sources are used when possible,
+            otherwise ASpell is used (if `spelling` is set, and it is
+            available).
+            Returns a list of words, or [] if there are none.
+        """
+        similar = self.similar(word, limit=limit)
+        if similar:
+            return [w for w, _ in similar]
+        if not self.spelling:
+            return []
+        # The SpellChecker's cache isn't safe to share between threads.
+        with self.lock:
+            if not load_spellchecker():
+                return []
+            try:
+                results = spellchecker.check_word(word)
+            except spell.SpellChecker.ASpellError:
+                return []
+        return (results or {}).get(word, None) or []
+
+    def words(self, prefix, pos=None, limit=COMPLETELIMIT):
+        """ Find the words starting with `prefix`, in sorted order.
+            If `pos` is given (see pos_key()), only words with a definition
+            for that part of speech are found, with an index range query
+            when possible.
+            Returns a list of up to `limit` uppercase words.
+        """
+        words = set()
+        for _, found in self.query('find_words', prefix.upper(), pos, limit):
+            words.update(found)
+        return sorted(words)[:limit]
+
+
+class DefineRequestHandler(object):
+
+    """ Handles requests for the --http service, as JSON.
+        This is mixed with http.server.BaseHTTPRequestHandler, which is
+        only imported when it is needed (see main_http()).
+        Connections are kept open between requests, but each handle() is
+        only one request. PoolingMixIn watches the connection until the
+        next one arrives, so an idle connection doesn't hold a worker.
+    """
+
+    protocol_version = 'HTTP/1.1'
+    server_version = '{}/{}'.format(NAME, VERSION)
+    # Requests that stop arriving part way through are given up on.
+    timeout = HTTPTIMEOUT
+    # Headers and body are written separately, without this the body
+    # waits for the client's delayed ACK (about 40ms per request).
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        self.handle_endpoint('GET')
+
+    def do_POST(self):
+        self.handle_endpoint('POST')
+
+    def finish(self):
+        # The connection stays open for the next request, see handle().
+        if self.close_connection:
+            super().finish()
+
+    def handle(self):
+        """ Handle one request, instead of every request on the connection.
+            Unless close_connection is set, the server calls this again when
+            the next request arrives.
+        """
+        self.close_connection = True
+        self.handle_one_request()
+
+    def handle_endpoint(self, method):
+        """ Run the endpoint for a request, and send the JSON response. """
+        from urllib.parse import unquote, urlsplit
+        starttime = time.perf_counter()
+        path = urlsplit(self.path).path
+        name, _, arg = path.strip('/').partition('/')
+        endpoint = self.endpoints.get((method, name), None)
+        try:
+            # The body is always read, so the connection can be reused.
+            body = self.read_body()
+            if endpoint is None:
+                status, response = 404, {'error': 'Not found.'}
+            else:
+                status, response = endpoint(self, unquote(arg), body)
+        except ValueError as ex:
+            status, response = 400, {'error': str(ex)}
+        self.send_json(status, response)
+        self.server.metrics.record(
+            name if endpoint else None,
+            status,
+            time.perf_counter() - starttime)
+
+    def log_message(self, format, *args):
+        """ Requests aren't logged, see /metrics instead. """
+        pass
+
+    def read_body(self):
+        """ Read the request body, raises ValueError for bad bodies.
+            Returns the body as bytes, or b'' if there is none.
+        """
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+        except ValueError:
+            self.close_connection = True
+            raise ValueError('Invalid Content-Length.')
+        if length > HTTPMAXBODY:
+            self.close_connection = True
+            raise ValueError('Request body is too large.')
+        return self.rfile.read(length) if length > 0 else b''
+
+    def send_json(self, status, response):
+        """ Send a JSON response, with a length so the connection can be
+            reused. The client is told when it will be closed instead
+            (see read_body()).
+        """
+        content = json.dumps(response).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(content)))
+        if self.close_connection:
+            self.send_header('Connection', 'close')
+        self.end_headers()
+        self.wfile.write(content)
+
+    def endpoint_batch(self, arg, body):
+        """ POST /batch, with a JSON list of words. """
+        try:
+            words = json.loads(body.decode('utf-8'))
+        except ValueError:
+            raise ValueError('Expecting a JSON list of words.')
+        if not (
+                isinstance(words, list) and
+                all(isinstance(w, str) and w for w in words)):
+            raise ValueError('Expecting a JSON list of words.')
+        return 200, define_words(self.server.dictionary, words)
+
+    def endpoint_define(self, arg, body):
+        """ GET /define/WORD """
+        if not arg:
+            raise ValueError('No word given.')
+        result = define_words(self.server.dictionary, [arg])[arg]
+        result['word'] = arg
+        return (200 if result['definitions'] else 404), result
+
+    def endpoint_metrics(self, arg, body):
+        """ GET /metrics """
+        stats = self.server.metrics.stats()
+        if spellchecker is not None:
+            stats['spellcache'] = spellchecker.cache.stats()
+        return 200, stats
+
+    def endpoint_suggest(self, arg, body):
+        """ GET /suggest/WORD """
+        if not arg:
+            raise ValueError('No word given.')
+        return 200, {
+            'word': arg,
+            'suggestions': self.server.dictionary.suggest(arg),
+        }
+
+    # Endpoints by (method, name).
+    endpoints = {
+        ('GET', 'define'): endpoint_define,
+        ('GET', 'metrics'): endpoint_metrics,
+        ('GET', 'suggest'): endpoint_suggest,
+        ('POST', 'batch'): endpoint_batch,
+    }
+
+
+class PoolingMixIn(object):
+
+    """ Handles each connection with a fixed pool of worker threads, like
+        socketserver.ThreadingMixIn without starting a thread for every
+        connection. Connections wait in line when all workers are busy.
+        With a handler that handles one request at a time (like
+        DefineRequestHandler), kept-alive connections are watched by one
+        thread between requests, and wait in line again when the next
+        request arrives. They are closed after `idle_timeout` seconds.
+        Request metrics are kept in `metrics`.
+    """
+
+    # Seconds before an idle connection is closed.
+    idle_timeout = HTTPTIMEOUT
+
+    def __init__(self, *args, workers=HTTPWORKERS, **kwargs):
+        from concurrent.futures import ThreadPoolExecutor
+        import selectors
+        import socket
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.metrics = ServerMetrics()
+        super().__init__(*args, **kwargs)
+        # Idle connections, as {socket: (handler, time it became idle)}.
+        # Workers add them while the watcher waits, with idlelock held.
+        self.idle = selectors.DefaultSelector()
+        self.idlelock = threading.Lock()
+        self.idleclosing = False
+        # The watcher is woken up to close, and when a connection is added
+        # to a selector that only sees it the next time it waits.
+        self.wakeupreader, self.wakeupwriter = socket.socketpair()
+        self.idle.register(self.wakeupreader, selectors.EVENT_READ)
+        liveselectors = tuple(
+            getattr(selectors, name)
+            for name in ('EpollSelector', 'KqueueSelector')
+            if hasattr(selectors, name))
+        self.idlewakeup = not isinstance(self.idle, liveselectors)
+        self.watcher = threading.Thread(
+            target=self.watch_idle,
+            name='{}-idle'.format(NAME),
+            daemon=True)
+        self.watcher.start()
+
+    def close_idle(self, handler):
+        """ Close a kept-alive connection. """
+        handler.close_connection = True
+        try:
+            handler.finish()
+        except (EnvironmentError, ValueError):
+            # The client is already gone.
+            pass
+        self.shutdown_request(handler.request)
+
+    def finish_request(self, request, client_address):
+        """ Handle the first request on a connection, and return the
+            handler for the next ones.
+        """
+        return self.RequestHandlerClass(request, client_address, self)
+
+    def keep_idle(self, handler):
+        """ After a request, close the connection or wait for the next
+            request on it, without holding a worker.
+        """
+        import selectors
+        if getattr(handler, 'close_connection', True):
+            self.shutdown_request(handler.request)
+            return
+        if request_waiting(handler):
+            # It's already here (pipelined), back in line for a worker.
+            try:
+                self.executor.submit(self.process_next_request, handler)
+            except RuntimeError:
+                # The server is closing.
+                self.close_idle(handler)
+            return
+        with self.idlelock:
+            if not self.idleclosing:
+                self.idle.register(
+                    handler.connection,
+                    selectors.EVENT_READ,
+                    (handler, time.monotonic()))
+                handler = None
+        if handler is not None:
+            self.close_idle(handler)
+        elif self.idlewakeup:
+            self.wakeupwriter.send(b'\0')
+
+    def process_next_request(self, handler):
+        """ Handle the next request on a kept-alive connection. """
+        try:
+            try:
+                handler.handle()
+            finally:
+                handler.finish()
+        except Exception:
+            self.handle_error(handler.request, handler.client_address)
+            self.shutdown_request(handler.request)
+            return
+        self.keep_idle(handler)
+
+    def process_request(self, request, client_address):
+        self.executor.submit(
+            self.process_request_worker,
+            request,
+            client_address)
+
+    def process_request_worker(self, request, client_address):
+        try:
+            handler = self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+            self.shutdown_request(request)
+            return
+        self.keep_idle(handler)
+
+    def server_close(self):
+        super().server_close()
+        with self.idlelock:
+            self.idleclosing = True
+        self.wakeupwriter.send(b'\0')
+        self.watcher.join()
+        self.executor.shutdown(wait=True)
+        self.idle.close()
+        self.wakeupreader.close()
+        self.wakeupwriter.close()
+
+    def watch_idle(self):
+        """ Watch the idle connections in a thread of its own. Connections
+            with a new request go back in line for a worker, and the ones
+            that have been idle for too long are closed.
+        """
+        while True:
+            for key, _ in self.idle.select(timeout=1):
+                if key.fileobj is self.wakeupreader:
+                    self.wakeupreader.recv(4096)
+                    continue
+                with self.idlelock:
+                    self.idle.unregister(key.fileobj)
+                handler, _ = key.data
+                self.executor.submit(self.process_next_request, handler)
+            with self.idlelock:
+                closing = self.idleclosing
+                now = time.monotonic()
+                expired = [
+                    key for key in self.idle.get_map().values()
+                    if (key.fileobj is not self.wakeupreader) and (
+                        closing or (now - key.data[1] > self.idle_timeout))
+                ]
+                for key in expired:
+                    self.idle.unregister(key.fileobj)
+            for key in expired:
+                self.close_idle(key.data[0])
+            if closing:
+                return
+
+
+class ServerMetrics(object):
+
+    """ Counts requests for the --http service, by endpoint and status,
+        with a latency histogram for each endpoint.
+        One ServerMetrics is shared between the worker threads.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.starttime = time.time()
+        self.statuses = {}
+        # {endpoint: [count, total seconds, [count per bucket]]}
+        self.endpoints = {}
+
+    def record(self, endpoint, status, seconds):
+        """ Count a request. Unknown endpoints are counted as 'other'. """
+        milliseconds = seconds * 1000
+        bucket = len(HTTPBUCKETS)
+        for i, upper in enumerate(HTTPBUCKETS):
+            if milliseconds <= upper:
+                bucket = i
+                break
+        with self.lock:
+            self.statuses[status] = self.statuses.get(status, 0) + 1
+            counts = self.endpoints.setdefault(
+                endpoint or 'other',
+                [0, 0.0, [0] * (len(HTTPBUCKETS) + 1)])
+            counts[0] += 1
+            counts[1] += seconds
+            counts[2][bucket] += 1
+
+    def stats(self):
+        """ Returns a dict of the metrics, for JSON. The latency histogram
+            is keyed by the upper bound in milliseconds.
+        """
+        labels = ['<={}'.format(upper) for upper in HTTPBUCKETS]
+        labels.append('>{}'.format(HTTPBUCKETS[-1]))
+        with self.lock:
+            endpoints = {
+                name: {
+                    'count': count,
+                    'mean_ms': round(total * 1000 / count, 3),
+                    'latency_ms': OrderedDict(zip(labels, buckets)),
+                }
+                for name, (count, total, buckets) in self.endpoints.items()
+            }
+            return {
+                'uptime': round(time.time() - self.starttime, 3),
+                'requests': sum(self.statuses.values()),
+                'statuses': {str(k): v for k, v in self.statuses.items()},
+                'endpoints': endpoints,
+            }
+
+
 class ColorCodes(object):
 
     """ This class colorizes text for an ansi terminal.
@@ -686,5 +3963,10 @@ else:
     color = colorize.colorword
 
 if __name__ == '__main__':
+    if sys.argv[1:2] == ['--complete']:
+        # Shell completion needs to be fast, so docopt is skipped.
+        sys.exit(main_complete(*parse_complete_args(sys.argv[2:])))
+
+    from docopt import docopt
     mainret = main(docopt(USAGESTR, version=VERSIONSTR))
     sys.exit(mainret)
@@ -0,0 +1,469 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" loadtest.py
+    ...Replays a realistic lookup workload against define.py, and reports
+    throughput and latency for each backend as JSON.
+    Everything runs offline, against a synthetic dictionary.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import redirect_stdout
+from docopt import docopt
+from urllib.parse import quote
+import bisect
+import http.client
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+import define
+
+NAME = 'LoadTest'
+VERSION = '0.0.1'
+VERSIONSTR = '{} v. {}'.format(NAME, VERSION)
+SCRIPT = os.path.split(os.path.abspath(sys.argv[0]))[1]
+# Backends that can be tested, see BACKENDS at the bottom.
+BACKENDNAMES = ('db', 'memory', 'text', 'http')
+# Default backends, the text backend is slow enough to skip by default.
+DEFAULTBACKENDS = ('db', 'memory', 'http')
+# Default concurrency levels.
+CONCURRENCY = (1, 4, 16)
+# Default number of lookups for each backend and concurrency level.
+REQUESTS = 2000
+# Default number of headwords in the synthetic dictionary.
+WORDCOUNT = 20000
+# Default exponent for the Zipf distribution of lookups.
+ZIPFEXP = 1.1
+# Default fractions of lookups for unknown words, and misspelled words.
+MISSRATE = 0.05
+MISSPELLRATE = 0.05
+# Default seed for the dictionary and the workload.
+SEED = 1
+
+USAGESTR = """{versionstr}
+    Usage:
+        {script} -h | -v
+        {script} [-b name]... [-c num]... [-m rate] [-n num] [-o file]
+                    [-s rate] [-S seed] [-w num] [-z exp]
+
+    Options:
+        -b name,--backend name      : Backend to test, one of:
+                                      {backendnames}
+                                      Default: {defaultbackends}
+        -c num,--concurrency num    : Number of lookups at once.
+                                      Default: {concurrency}
+        -h,--help                   : Show this help message.
+        -m rate,--misses rate       : Fraction of lookups for words that
+                                      aren't in the dictionary.
+                                      Default: {missrate}
+        -n num,--requests num       : Number of lookups for each backend
+                                      and concurrency level.
+                                      Default: {requests}
+        -o file,--output file       : Write the JSON report to a file.
+                                      Default: stdout
+        -s rate,--misspell rate     : Fraction of lookups for misspelled
+                                      words.
+                                      Default: {misspellrate}
+        -S seed,--seed seed         : Random seed, for repeatable runs.
+                                      Default: {seed}
+        -v,--version                : Show version.
+        -w num,--words num          : Number of words in the synthetic
+                                      dictionary.
+                                      Default: {wordcount}
+        -z exp,--zipf exp           : Exponent for the Zipf distribution
+                                      of lookups. Higher values make
+                                      common words more common.
+                                      Default: {zipfexp}
+
+    Lookups go through the same path as `define`, including root words
+    and suggestions for words that aren't found (without aspell).
+    The http backend runs `define --http` in this process.
+""".format(
+    script=SCRIPT,
+    versionstr=VERSIONSTR,
+    backendnames=', '.join(BACKENDNAMES),
+    defaultbackends=', '.join(DEFAULTBACKENDS),
+    concurrency=', '.join(str(c) for c in CONCURRENCY),
+    missrate=MISSRATE,
+    requests=REQUESTS,
+    misspellrate=MISSPELLRATE,
+    seed=SEED,
+    wordcount=WORDCOUNT,
+    zipfexp=ZIPFEXP)
+
+# Syllables for making up words.
+SYLLABLES = (
+    'a', 'ab', 'ac', 'al', 'an', 'ar', 'be', 'bi', 'ca', 'co', 'con', 'de',
+    'di', 'en', 'er', 'es', 'fa', 'for', 'ga', 'hy', 'i', 'in', 'is', 'la',
+    'le', 'li', 'lo', 'ma', 'me', 'mi', 'mo', 'na', 'ne', 'ni', 'no', 'o',
+    'or', 'pa', 'pe', 'per', 'po', 'pro', 'ra', 're', 'ri', 'ro', 'sa',
+    'se', 'si', 'ta', 'te', 'ter', 'ti', 'to', 'tra', 'u', 'un', 've', 'vi',
+)
+POSTAGS = ('n.', 'v. t.', 'v. i.', 'a.', 'adv.')
+LETTERS = 'abcdefghijklmnopqrstuvwxyz'
+
+
+def main(argd):
+    """ Main entry point, expects docopt arg dict as argd """
+    try:
+        backends = argd['--backend'] or list(DEFAULTBACKENDS)
+        for backend in backends:
+            if backend not in BACKENDS:
+                raise ValueError('Unknown backend: {}'.format(backend))
+        concurrency = [
+            parse_int(c, 'concurrency') for c in argd['--concurrency']
+        ] or list(CONCURRENCY)
+        requests = parse_int(argd['--requests'] or REQUESTS, 'requests')
+        wordcount = parse_int(argd['--words'] or WORDCOUNT, 'words')
+        seed = parse_int(argd['--seed'] or SEED, 'seed')
+        missrate = parse_rate(argd['--misses'] or MISSRATE, 'misses')
+        misspellrate = parse_rate(
+            argd['--misspell'] or MISSPELLRATE,
+            'misspell')
+        zipfexp = float(argd['--zipf'] or ZIPFEXP)
+    except ValueError as ex:
+        print_err(ex)
+        return 1
+
+    rand = random.Random(seed)
+    tempdir = tempfile.mkdtemp(prefix='define-loadtest-')
+    try:
+        print_err('Building a dictionary of {} words...'.format(wordcount))
+        textfile, dbfile, words = build_dictionary(tempdir, wordcount, rand)
+        workload = make_workload(
+            words,
+            requests,
+            rand,
+            zipfexp=zipfexp,
+            missrate=missrate,
+            misspellrate=misspellrate)
+        results = []
+        for backend in backends:
+            for threads in concurrency:
+                print_err('Testing {} with {} at once...'.format(
+                    backend,
+                    threads))
+                results.append(
+                    BACKENDS[backend](textfile, dbfile, workload, threads))
+    finally:
+        shutil.rmtree(tempdir, ignore_errors=True)
+
+    report = {
+        'dictionary': {'words': wordcount, 'seed': seed},
+        'workload': {
+            'requests': requests,
+            'zipf': zipfexp,
+            'misses': missrate,
+            'misspellings': misspellrate,
+        },
+        'results': results,
+    }
+    reportjson = json.dumps(report, indent=4)
+    if argd['--output']:
+        with open(argd['--output'], 'w') as f:
+            f.write(reportjson)
+            f.write('\n')
+    else:
+        print(reportjson)
+    return 0
+
+
+def build_dictionary(dirname, wordcount, rand):
+    """ Write a synthetic dictionary in Webster's format to `dirname`, and
+        convert it to a database like `define -c` does.
+        Returns a tuple of (text file name, database file name, words),
+        where `words` is a list of the lowercase headwords.
+    """
+    words = set()
+    while len(words) < wordcount:
+        words.add(''.join(
+            rand.choice(SYLLABLES) for _ in range(rand.randint(1, 4))))
+    words = sorted(words)
+    textfile = os.path.join(dirname, 'dictionary.txt')
+    with open(textfile, 'w', encoding=define.DICTENCODING) as f:
+        f.write('Synthetic dictionary for {}\n\n'.format(SCRIPT))
+        for word in words:
+            for _ in range(2 if rand.random() < 0.1 else 1):
+                f.write(make_entry(word, rand))
+        f.write('End of Project Gutenberg\'s Synthetic Dictionary\n')
+
+    dbfile = os.path.join(dirname, 'dictionary.sqlite3')
+    con = define.create_sqlite_db(dbfile)
+    cursor = con.cursor()
+    # insert_into_sqlite_db() prints every definition.
+    with open(textfile, 'rb') as fin, open(os.devnull, 'w') as devnull:
+        with redirect_stdout(devnull):
+            for word, defs in define.dict_words(fin).items():
+                define.insert_into_sqlite_db(cursor, word, defs)
+    con.commit()
+    define.index_sqlite_db(cursor)
+    con.commit()
+    con.close()
+    return textfile, dbfile, words
+
+
+def make_entry(word, rand):
+    """ Make up a dictionary entry for a word, in Webster's format. """
+    lines = [
+        word.upper(),
+        '{}, {} Etym: [L. {}.]'.format(
+            word.capitalize(),
+            rand.choice(POSTAGS),
+            rand.choice(SYLLABLES)),
+        '',
+    ]
+    if rand.random() < 0.4:
+        for i in range(1, rand.randint(2, 4)):
+            lines.extend((
+                '{}. A made up meaning of {}, number {},'.format(i, word, i),
+                'written on more than one line.',
+                '',
+            ))
+    else:
+        lines.extend((
+            'Defn: A made up meaning of {}, which is written'.format(word),
+            'on more than one line.',
+            '',
+        ))
+    return '\n'.join(lines) + '\n'
+
+
+def make_workload(
+        words, count, rand,
+        zipfexp=ZIPFEXP, missrate=MISSRATE, misspellrate=MISSPELLRATE):
+    """ Make a list of `count` words to look up.
+        Words are drawn from a Zipf distribution over `words` (in a random
+        order, so popular words are spread out), with some words that
+        aren't in the dictionary, and some misspelled words.
+    """
+    ranked = list(words)
+    rand.shuffle(ranked)
+    weights = []
+    total = 0.0
+    for rank in range(1, len(ranked) + 1):
+        total += 1 / (rank ** zipfexp)
+        weights.append(total)
+    known = set(words)
+    workload = []
+    for _ in range(count):
+        roll = rand.random()
+        if roll < missrate:
+            word = make_unknown(rand, known)
+        else:
+            i = bisect.bisect_left(weights, rand.random() * total)
+            word = ranked[min(i, len(ranked) - 1)]
+            if roll < (missrate + misspellrate):
+                word = misspell(word, rand)
+        workload.append(word)
+    return workload
+
+
+def make_unknown(rand, known):
+    """ Make up a word that isn't in the dictionary. """
+    while True:
+        word = ''.join(
+            rand.choice(LETTERS) for _ in range(rand.randint(4, 10)))
+        if word not in known:
+            return word
+
+
+def misspell(word, rand):
+    """ Misspell a word with one edit: a deleted, added, changed, or
+        swapped letter.
+    """
+    i = rand.randrange(len(word))
+    edit = rand.choice(('delete', 'insert', 'replace', 'swap'))
+    if (edit == 'delete') and (len(word) > 1):
+        return word[:i] + word[i + 1:]
+    if (edit == 'swap') and (i < len(word) - 1):
+        return word[:i] + word[i + 1] + word[i] + word[i + 2:]
+    if edit == 'insert':
+        return word[:i] + rand.choice(LETTERS) + word[i:]
+    return word[:i] + rand.choice(LETTERS.replace(word[i], '')) + word[i + 1:]
+
+
+def parse_int(s, name):
+    """ Parse a positive integer option, raises ValueError. """
+    try:
+        value = int(s)
+    except (TypeError, ValueError):
+        value = 0
+    if value < 1:
+        raise ValueError('Invalid number for --{}: {}'.format(name, s))
+    return value
+
+
+def parse_rate(s, name):
+    """ Parse a fraction (0-1) option, raises ValueError. """
+    try:
+        value = float(s)
+    except (TypeError, ValueError):
+        value = -1
+    if not (0 <= value <= 1):
+        raise ValueError('Invalid fraction for --{}: {}'.format(name, s))
+    return value
+
+
+def percentile(ordered, pct):
+    """ Returns a percentile (0-100) from a sorted list, by nearest rank.
+    """
+    if not ordered:
+        return 0
+    rank = max(int(round(pct / 100 * len(ordered) + 0.5)) - 1, 0)
+    return ordered[min(rank, len(ordered) - 1)]
+
+
+def print_err(msg):
+    """ Print a progress or error message to stderr. """
+    print(msg, file=sys.stderr)
+
+
+def run_load(name, workload, threads, lookup, setup=None):
+    """ Run every lookup in `workload`, `threads` at a time.
+        Arguments:
+            name      : Backend name, for the results.
+            workload  : A list of words to look up.
+            threads   : Number of lookups at once.
+            lookup    : A function to call with (state, word), returning
+                        True if the word was found.
+            setup     : A function to call once in each thread, returning
+                        a `state` for lookup(). Default: None is used.
+        Returns a dict of results: throughput in lookups per second,
+        p50, p95, and p99 latencies in milliseconds, and misses.
+    """
+    # Each thread takes the next word from the workload.
+    words = iter(workload)
+    wordlock = threading.Lock()
+
+    def worker():
+        state = setup() if setup else None
+        latencies = []
+        misses = 0
+        while True:
+            with wordlock:
+                word = next(words, None)
+            if word is None:
+                break
+            starttime = time.perf_counter()
+            if not lookup(state, word):
+                misses += 1
+            latencies.append(time.perf_counter() - starttime)
+        if hasattr(state, 'close'):
+            state.close()
+        return latencies, misses
+
+    starttime = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        futures = [executor.submit(worker) for _ in range(threads)]
+        results = [future.result() for future in futures]
+    duration = time.perf_counter() - starttime
+
+    latencies = sorted(
+        latency * 1000 for threadlatencies, _ in results
+        for latency in threadlatencies)
+    return {
+        'backend': name,
+        'concurrency': threads,
+        'requests': len(latencies),
+        'misses': sum(misses for _, misses in results),
+        'seconds': round(duration, 3),
+        'throughput': round(len(latencies) / duration, 1),
+        'p50_ms': round(percentile(latencies, 50), 3),
+        'p95_ms': round(percentile(latencies, 95), 3),
+        'p99_ms': round(percentile(latencies, 99), 3),
+    }
+
+
+def test_dictionary(name, sources, workload, threads):
+    """ Test lookups in a define.Dictionary, like `define` does them.
+        Words that aren't found get suggestions, without aspell.
+    """
+    with define.Dictionary(sources, spelling=False) as dictionary:
+
+        def lookup(state, word):
+            result = define.define_words(dictionary, [word])[word]
+            if result['definitions']:
+                return True
+            dictionary.suggest(word)
+            return False
+
+        return run_load(name, workload, threads, lookup)
+
+
+def test_db(textfile, dbfile, workload, threads):
+    """ Test lookups in the database. """
+    sources = [define.DBSource(dbfile, name='websters')]
+    return test_dictionary('db', sources, workload, threads)
+
+
+def test_http(textfile, dbfile, workload, threads):
+    """ Test lookups through `define --http`, with one connection for each
+        thread. The server has one worker for each connection.
+    """
+    sources = [define.DBSource(dbfile, name='websters')]
+    with define.Dictionary(sources, spelling=False) as dictionary:
+        server = define.http_server(
+            dictionary,
+            'localhost',
+            0,
+            workers=threads)
+        host, port = server.server_address[:2]
+        serverthread = threading.Thread(target=server.serve_forever)
+        serverthread.start()
+        try:
+
+            def lookup(con, word):
+                path = quote(word)
+                con.request('GET', '/define/{}'.format(path))
+                response = con.getresponse()
+                response.read()
+                if response.status == 200:
+                    return True
+                con.request('GET', '/suggest/{}'.format(path))
+                con.getresponse().read()
+                return False
+
+            return run_load(
+                'http',
+                workload,
+                threads,
+                lookup,
+                setup=lambda: http.client.HTTPConnection(host, port))
+        finally:
+            server.shutdown()
+            server.server_close()
+            serverthread.join()
+
+
+def test_memory(textfile, dbfile, workload, threads):
+    """ Test lookups in the database, preloaded into memory. """
+    source = define.DBSource(dbfile, name='websters')
+    sources = [define.MemorySource(source)]
+    return test_dictionary('memory', sources, workload, threads)
+
+
+def test_text(textfile, dbfile, workload, threads):
+    """ Test lookups in the text file, without a database. """
+    sources = [define.TextSource(textfile, name='websters')]
+    return test_dictionary('text', sources, workload, threads)
+
+
+# Functions to test each backend, with:
+#   (text file name, database file name, workload, concurrency)
+BACKENDS = {
+    'db': test_db,
+    'http': test_http,
+    'memory': test_memory,
+    'text': test_text,
+}
+
+
+if __name__ == '__main__':
+    mainret = main(docopt(USAGESTR, version=VERSIONSTR))
+    sys.exit(mainret)
@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" scanbench.py
+    ...Measures how fast define.py scans the plain text dictionary, in
+    MB/s, and reports the results as JSON.
+    The lines scanner only reads and strips each line with Python's own
+    line iterator. The original scanner runs the line by line parser that
+    define.py used before it scanned whole chunks, which is copied here so
+    the speedup can still be measured.
+"""
+
+from docopt import docopt
+import json
+import os
+import re
+import sys
+import time
+
+import define
+
+NAME = 'ScanBench'
+VERSION = '0.0.1'
+VERSIONSTR = '{} v. {}'.format(NAME, VERSION)
+SCRIPT = os.path.split(os.path.abspath(sys.argv[0]))[1]
+# Scanners that can be measured, see SCANNERS at the bottom.
+SCANNERNAMES = ('lines', 'original', 'headwords', 'definitions', 'lookup')
+# Default number of runs for each scanner. The best run is reported.
+RUNS = 3
+# A word that isn't in the dictionary, so the lookup scans the whole file.
+MISSINGWORD = 'NOTAWORDATALL'
+# Patterns for the original parser, see original_definitions().
+ORIGINALWORDPAT = re.compile(r'^[A-Z\-]+$')
+ORIGINALLISTPAT = re.compile(r'^[1-9]{1,3}\.')
+
+USAGESTR = """{versionstr}
+    Usage:
+        {script} -h | -v
+        {script} [-f file] [-o file] [-r num] [-s name]...
+
+    Options:
+        -f file,--file file         : Dictionary file to scan.
+                                      Default: {dictfile}
+        -h,--help                   : Show this help message.
+        -o file,--output file       : Write the JSON report to a file.
+                                      Default: stdout
+        -r num,--runs num           : Number of runs for each scanner.
+                                      Default: {runs}
+        -s name,--scanner name      : Scanner to measure, one of:
+                                      {scannernames}
+                                      Default: all of them
+        -v,--version                : Show version.
+
+    Scanners:
+        lines        : Read and strip every line, as a baseline.
+        original     : Build every definition with the original line by
+                       line parser, to compare with definitions.
+        headwords    : Find every headword, see define.iter_headwords().
+        definitions  : Build every definition, see define.iter_definitions().
+        lookup       : Look up a missing word without a database, which
+                       scans the whole file. See define.find_entries_infile().
+""".format(
+    script=SCRIPT,
+    versionstr=VERSIONSTR,
+    dictfile=define.DICTFILE,
+    runs=RUNS,
+    scannernames=', '.join(SCANNERNAMES))
+
+
+def main(argd):
+    """ Main entry point, expects docopt arg dict as argd """
+    filename = argd['--file'] or define.DICTFILE
+    scanners = argd['--scanner'] or list(SCANNERNAMES)
+    try:
+        for scanner in scanners:
+            if scanner not in SCANNERS:
+                raise ValueError('Unknown scanner: {}'.format(scanner))
+        runs = parse_int(argd['--runs'] or RUNS, 'runs')
+        size = os.path.getsize(filename)
+    except (EnvironmentError, ValueError) as ex:
+        print_err(ex)
+        return 1
+
+    results = []
+    for scanner in scanners:
+        print_err('Scanning with {}...'.format(scanner))
+        results.append(run_scanner(scanner, filename, size, runs))
+    original = [r for r in results if r['scanner'] == 'original']
+    if original:
+        # How many times faster than the original parser each scanner is.
+        for result in results:
+            result['speedup'] = round(
+                result['mb_per_s'] / original[0]['mb_per_s'],
+                2)
+
+    report = {
+        'file': {'name': filename, 'bytes': size},
+        'runs': runs,
+        'results': results,
+    }
+    reportjson = json.dumps(report, indent=4)
+    if argd['--output']:
+        with open(argd['--output'], 'w') as f:
+            f.write(reportjson)
+            f.write('\n')
+    else:
+        print(reportjson)
+    return 0
+
+
+def original_definitions(f):
+    """ The line by line parser that define.iter_definitions() replaced,
+        copied as it was (without the lambdas). It drops the last word
+        before an end marker, so it finds one definition less.
+        Iterate over the entire file, yielding ('word', 'definition').
+        Arguments:
+            f  : An open file object, for the dictionary file.
+    """
+    # Start of a definition
+    defstart = 'Defn: '
+    defstartlen = len(defstart)
+    # Place holder for results.
+    currentword = None
+    deflines = None
+
+    for line in f:
+        l = line.strip()  # noqa
+        if not l:
+            # Blank line
+            continue
+        if l.startswith(('*** END', 'End of Project')):
+            # End of definitions.
+            return
+
+        if ORIGINALWORDPAT.match(l):
+            if deflines and (deflines is not None):
+                # This is the next word.
+                yield currentword, '\n'.join(deflines).strip()
+            # Start of a word.
+            currentword = l
+            deflines = []
+        else:
+            if deflines is None:
+                # Skip the header
+                continue
+            # This is part of a definition.
+            # If we have already added some lines,
+            # this is part of the current word's definition.
+            if ORIGINALLISTPAT.match(l):
+                deflines.append('\n{}'.format(l))
+            else:
+                if l.startswith(defstart):
+                    # Beginning of definition.
+                    deflines.append(''.join(('\n', l[defstartlen:])))
+                else:
+                    # Rest of the def.
+                    deflines.append(l)
+    # The last word in the file.
+    if deflines:
+        yield currentword, '\n'.join(deflines).strip()
+
+
+def parse_int(s, name):
+    """ Parse a positive integer option, raises ValueError. """
+    try:
+        value = int(s)
+    except (TypeError, ValueError):
+        value = 0
+    if value < 1:
+        raise ValueError('Invalid number for --{}: {}'.format(name, s))
+    return value
+
+
+def print_err(msg):
+    """ Print a progress or error message to stderr. """
+    print(msg, file=sys.stderr)
+
+
+def run_scanner(name, filename, size, runs):
+    """ Run a scanner over the whole file `runs` times.
+        Returns a dict with the best time, the throughput for that time,
+        and the number of items that were found.
+    """
+    scanner = SCANNERS[name]
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        count = scanner(filename)
+        times.append(time.perf_counter() - start)
+    best = min(times)
+    return {
+        'scanner': name,
+        'items': count,
+        'seconds': round(best, 4),
+        'mb_per_s': round(size / best / 1e6, 1),
+    }
+
+
+def scan_definitions(filename):
+    """ Build every definition in the file. """
+    with open(filename, 'rb') as f:
+        return sum(1 for _ in define.iter_definitions(f))
+
+
+def scan_headwords(filename):
+    """ Find every headword in the file. """
+    with open(filename, 'rb') as f:
+        return sum(1 for _ in define.iter_headwords(f))
+
+
+def scan_lines(filename):
+    """ Read and strip every line in the file, without looking at it. """
+    with open(
+            filename,
+            encoding=define.DICTENCODING,
+            errors='replace') as f:
+        return sum(1 for line in f if line.strip())
+
+
+def scan_lookup(filename):
+    """ Look up a word that isn't in the file. """
+    with open(filename, 'rb') as f:
+        return len(define.find_entries_infile(f, [MISSINGWORD]))
+
+def scan_original(filename):
+    """ Build every definition in the file with the original parser. """
+    with open(
+            filename,
+            encoding=define.DICTENCODING,
+            errors='replace') as f:
+        return sum(1 for _ in original_definitions(f))
+
+
+# Functions to run each scanner, with the file name.
+# They return the number of items that were found.
+SCANNERS = {
+    'definitions': scan_definitions,
+    'headwords': scan_headwords,
+    'lines': scan_lines,
+    'lookup': scan_lookup,
+    'original': scan_original,
+}
+
+
+if __name__ == '__main__':
+    mainret = main(docopt(USAGESTR, version=VERSIONSTR))
+    sys.exit(mainret)
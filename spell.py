@@ -8,38 +8,84 @@
     -Christopher Welborn 08-15-2014
 """
 
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from docopt import docopt
 from subprocess import Popen, PIPE
 from tempfile import SpooledTemporaryFile
+import atexit
+import json
 import os
+import re
 import subprocess
 import sys
+import threading
 
 NAME = 'Spell'
 VERSION = '0.1.0'
 VERSIONSTR = '{} v. {}'.format(NAME, VERSION)
 SCRIPTDIR, SCRIPT = os.path.split(os.path.abspath(sys.argv[0]))
+# Default number of jobs for --report.
+JOBS = os.cpu_count() or 1
+# Highest return code, exit codes wrap around after 255.
+MAXRETCODE = 255
+# Maximum number of words remembered when skipping duplicate words.
+SEENLIMIT = 10000
+# Maximum number of results to remember, in memory and on disk.
+CACHESIZE = 5000
+# File for remembering results between runs, see SpellCache.
+CACHEFILE = os.path.join(
+    os.environ.get('XDG_CACHE_HOME', None) or os.path.expanduser('~/.cache'),
+    'define',
+    'spell_cache.json')
 
 USAGESTR = """{versionstr}
     Usage:
         {script} -h | -v
-        {script} [WORD...] [-i] [-D]
+        {script} [WORD...] [-i] [-C] [-D]
         {script} -c file
+        {script} -r FILE... [-j num] [-C] [-D]
 
     Options:
+        FILE                  : One or many files to check.
         WORD                  : One or many words to spell check.
                                 You can also just pass them as a single string.
         -c file,--check file  : Use the interactive aspell file checker.
+        -C,--cache            : Remember results between runs, in:
+                                {cachefile}
         -D,--debug            : Shows more debugging info.
         -h,--help             : Show this help message.
         -i,--incorrect        : Only show the incorrect words.
+        -j num,--jobs num     : Number of files/aspell processes to work
+                                on at once, for --report.
+                                Default: {jobs}
+        -r,--report           : Check files without interaction, and print
+                                the misspelled words, one per line:
+                                FILE<tab>LINE<tab>COLUMN<tab>WORD<tab>
+                                    SUGGESTION,SUGGESTION,...
+                                The number of misspelled words is printed
+                                on stderr at the end.
         -v,--version          : Show version.
 
-    The return code is the number of misspelled words overall when not using
-    the interactive file checker.
+    The return code is the number of misspelled words overall (up to
+    {maxret}) when not using the interactive file checker. With --report,
+    each word is only counted once. Otherwise only the last {seenlimit}
+    different words are remembered, and a word is counted again when it
+    shows up after that.
     Aspell has a large vocabulary, but it isn't perfect.
     This script will tell you if the word you are checking can't be found.
-""".format(script=SCRIPT, versionstr=VERSIONSTR)
+""".format(
+    script=SCRIPT,
+    versionstr=VERSIONSTR,
+    cachefile=CACHEFILE,
+    jobs=JOBS,
+    maxret=MAXRETCODE,
+    seenlimit=SEENLIMIT)
+
+# Number of words sent to aspell at once, for --report.
+BATCHSIZE = 200
+# This is what words look like in files, for --report.
+WORDPAT = re.compile(r"[^\W\d_]+(?:'[^\W\d_]+)*")
 
 # Global debug flag, set with -D,--debug
 DEBUG = False
@@ -51,7 +97,8 @@ def main(argd):
     DEBUG = argd['--debug']
 
     try:
-        spellcheck = SpellChecker()
+        spellcheck = SpellChecker(
+            cachefile=CACHEFILE if argd['--cache'] else None)
     except SpellChecker.NotSupported as ex:
         print('\nError:\n{}\n'.format(ex))
         return 1
@@ -65,24 +112,44 @@ def main(argd):
             ret = 1
         return ret
 
+    if argd['--report']:
+        try:
+            jobs = int(argd['--jobs']) if argd['--jobs'] else JOBS
+        except ValueError:
+            print('\nError, invalid number for --jobs: {}'.format(
+                argd['--jobs']))
+            return 1
+        try:
+            errorcount = report_files(spellcheck, argd['FILE'], jobs=jobs)
+        except SpellChecker.ASpellError as ex:
+            print('\nError, {}'.format(ex), file=sys.stderr)
+            return 1
+        # 256 misspelled words would look like success.
+        return min(errorcount, MAXRETCODE)
+
     if argd['WORD']:
         words = argd['WORD']
     else:
         if sys.stdin.isatty() and sys.stdout.isatty():
             # Helpful, for new users.
             print('\nReading from stdin until EOF (Ctrl + D)...\n')
-        words = sys.stdin.read().split()
+        # Words are checked as they are read, a line at a time.
+        words = iter_words(sys.stdin)
 
-    allresults = {}
+    errorcount = 0
     hidecorrect = argd['--incorrect']
-    for res in spellcheck.check_words_iter(words, include_empty=hidecorrect):
+    checked = spellcheck.check_words_iter(
+        unique_words(words),
+        include_empty=hidecorrect)
+    for res in checked:
         print_wordresults(res)
-        allresults.update(res)
+        sys.stdout.flush()
+        # Count the words that errored, instead of keeping all results.
+        errorcount += sum(1 for corrected in res.values() if corrected)
 
-    # Filter out the correct words, leaving only words that errored.
-    errorcount = [w for w in filter(lambda k:allresults[k], allresults)]
+    printdebug('Cache: {}'.format(spellcheck.cache.stats()))
     # Return code is the number of misspelled words.
-    return len(errorcount)
+    return min(errorcount, MAXRETCODE)
 
 
 def format_group(grp, longest):
@@ -93,6 +160,27 @@ def format_group(grp, longest):
     return '    {}'.format(''.join(formatted))
 
 
+def find_words(filename):
+    """ Find all words in a file, with their positions.
+        Returns a list of [('word', line, column)], both numbered from 1.
+        Raises EnvironmentError if the file can't be read.
+    """
+    words = []
+    with open(filename, 'r', encoding='utf-8', errors='replace') as f:
+        for lineno, line in enumerate(f, start=1):
+            words.extend(
+                (match.group(), lineno, match.start() + 1)
+                for match in WORDPAT.finditer(line)
+            )
+    return words
+
+
+def iter_words(fileobj):
+    """ Yield words from a file object, reading a line at a time. """
+    for line in fileobj:
+        yield from line.split()
+
+
 def print_corrections(corrected):
     """ Prints word corrections in a colored block. """
     # Get longest correction, for formatting. (with room for a space)
@@ -122,6 +210,81 @@ def printdebug(s):
         print('{}{}'.format(debuglbl, s))
 
 
+def report_files(spellcheck, filenames, jobs=JOBS):
+    """ Check the spelling in several files, and print a sorted report of
+        misspelled words (see print_report()).
+        Files are read at the same time, and then the unique words from all
+        of them are checked in bulk with `jobs` aspell processes.
+        Files that can't be read are reported on stderr, and skipped.
+        The number of misspelled words is printed on stderr, so the report
+        on stdout only has the words.
+        Returns the number of misspelled words.
+    """
+    filewords = {}
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = [
+            (filename, executor.submit(find_words, filename))
+            for filename in filenames
+        ]
+        for filename, future in futures:
+            try:
+                filewords[filename] = future.result()
+            except EnvironmentError as ex:
+                print('Unable to read {}: {}'.format(filename, ex),
+                      file=sys.stderr)
+
+    uniquewords = {
+        word for words in filewords.values() for word, _, _ in words
+    }
+    printdebug('Checking {} unique words in {} files.'.format(
+        len(uniquewords),
+        len(filewords)))
+    results = spellcheck.check_words_bulk(uniquewords, jobs=jobs)
+    print_report(filewords, results)
+    errorcount = sum(1 for corrected in results.values() if corrected)
+    print('Misspelled words: {}'.format(errorcount), file=sys.stderr)
+    return errorcount
+
+
+def print_report(filewords, results):
+    """ Print misspelled words, sorted by file, line, and column.
+        Each line is tab-separated:
+            FILE  LINE  COLUMN  WORD  SUGGESTION,SUGGESTION,...
+        Arguments:
+            filewords  : A dict of {filename: [('word', line, column)]},
+                         from find_words().
+            results    : A dict of {word: corrections}, from
+                         SpellChecker.check_words_bulk().
+    """
+    for filename in sorted(filewords):
+        for word, lineno, col in sorted(
+                filewords[filename], key=lambda wlc: wlc[1:]):
+            corrected = results.get(word, None)
+            if corrected:
+                print('\t'.join((
+                    filename,
+                    str(lineno),
+                    str(col),
+                    word,
+                    ','.join(corrected))))
+
+
+def unique_words(words, limit=SEENLIMIT):
+    """ Yield words from an iterable, skipping words that were already seen.
+        Only the last `limit` unique words are remembered, so memory use
+        doesn't grow with the input.
+    """
+    seen = OrderedDict()
+    for word in words:
+        if word in seen:
+            seen.move_to_end(word)
+            continue
+        seen[word] = None
+        if len(seen) > limit:
+            seen.popitem(last=False)
+        yield word
+
+
 class SpellChecker(object):
 
     """ A class that uses ASpell to check the spelling of words,
@@ -137,11 +300,43 @@ class SpellChecker(object):
         """ Raised when aspell can't be found. """
         pass
 
-    def __init__(self):
+    def __init__(self, cachesize=CACHESIZE, cachefile=None):
         """ Initializes the spell checker, raises SpellChecker.NotSupported()
             if ASpell can't be found.
+            Arguments:
+                cachesize  : Number of results to remember (0 disables it).
+                cachefile  : File name to save results to when the program
+                             exits, and load them from next time.
+                             Default: Only remember them in memory.
         """
         self.aspell_exe = self.which_aspell()
+        # A shared aspell process, see open_pipe().
+        self.pipe = None
+        self.usepipe = False
+        self.pipelock = threading.Lock()
+        self.cache = SpellCache(
+            self.cache_key(),
+            maxsize=cachesize,
+            filename=cachefile)
+        if cachefile:
+            self.cache.load()
+            atexit.register(self.cache.save)
+
+    def cache_key(self):
+        """ Returns a key for the aspell version and dictionary,
+            so cached results from another version/dictionary aren't used.
+            Upgrading aspell changes the executable's modification time.
+        """
+        try:
+            mtime = os.path.getmtime(self.aspell_exe)
+        except EnvironmentError:
+            mtime = 0
+        lang = (
+            os.environ.get('LC_ALL', None) or
+            os.environ.get('LANG', None) or
+            'default'
+        ).split('.')[0]
+        return '{}:{}:{}'.format(self.aspell_exe, mtime, lang)
 
     def check_file(self, filename):
         """ Run aspell on a file (The same as `aspell -c filename`)
@@ -160,7 +355,32 @@ class SpellChecker(object):
             Return a dict of {misspelled: possible_corrections}
             If the word is correct, return {}
             If there is no output from aspell, ASpellError is raised.
+            Results are cached, see SpellCache.
         """
+        results = self.cache.get(s)
+        if results is None:
+            results = self.check_word_uncached(s)
+            self.cache.set(s, results)
+        return results
+
+    def check_word_uncached(self, s):
+        """ Check a string/word with aspell, without using the cache.
+            The shared aspell process is used if open_pipe() was called,
+            otherwise a new process is started.
+            See check_word().
+        """
+        with self.pipelock:
+            if self.usepipe:
+                if self.pipe is None:
+                    self.pipe = ASpellPipe(
+                        self.aspell_exe or self.which_aspell())
+                try:
+                    return self.pipe.check_word(s)
+                except SpellChecker.ASpellError:
+                    # Aspell quit, it is started again for the next word.
+                    self.pipe.close()
+                    self.pipe = None
+                    raise
         aspellexe = self.aspell_exe or self.which_aspell()
         aspellcmd = [aspellexe, '-a']
         with TempInput(s) as stdin:
@@ -178,8 +398,10 @@ class SpellChecker(object):
         raise SpellChecker.ASpellError('\nASpell had no output.')
 
     def check_words_iter(self, words, include_empty=True):
-        """ Checks an iterable of words using check_word() and yields each
-            result as it is encountered.
+        """ Checks an iterable of words and yields each result as it is
+            encountered.
+            One aspell process is used for all of the words that aren't
+            cached, and each word is checked as soon as it is available.
 
             Arguments:
                 words         : An iterable of words to check.
@@ -188,11 +410,86 @@ class SpellChecker(object):
 
             Raises SpellChecker.ASpellError.
         """
+        # Aspell isn't started until a word isn't found in the cache.
+        pipe = None
+        try:
+            for word in words:
+                results = self.cache.get(word)
+                if results is None:
+                    if pipe is None:
+                        aspellexe = self.aspell_exe or self.which_aspell()
+                        pipe = ASpellPipe(aspellexe)
+                    results = pipe.check_word(word)
+                    self.cache.set(word, results)
+                if (not include_empty) and (not results):
+                    continue
+                yield results
+        finally:
+            if pipe is not None:
+                pipe.close()
+
+    def close_pipe(self):
+        """ Stop the shared aspell process started by open_pipe(). """
+        with self.pipelock:
+            self.usepipe = False
+            pipe, self.pipe = self.pipe, None
+        if pipe is not None:
+            pipe.close()
+
+    def open_pipe(self):
+        """ Start a shared aspell process for check_word(), instead of
+            starting a new process for each word. This is useful for
+            long-running programs. It may be used from several threads,
+            one word at a time.
+            Call close_pipe() when finished.
+        """
+        with self.pipelock:
+            self.usepipe = True
+            if self.pipe is None:
+                self.pipe = ASpellPipe(self.aspell_exe or self.which_aspell())
+
+    def check_words_bulk(self, words, jobs=1, batchsize=BATCHSIZE):
+        """ Checks many words at once, using the cache and `jobs` aspell
+            processes at the same time.
+            Words are sent to aspell `batchsize` at a time.
+            Raises SpellChecker.ASpellError.
+            Returns a dict of {word: corrections}, where corrections is
+            None for correct words.
+        """
+        allresults = {}
+        unchecked = []
         for word in words:
-            results = self.check_word(word)
-            if (not include_empty) and (not results):
-                continue
-            yield results
+            results = self.cache.get(word)
+            if results is None:
+                unchecked.append(word)
+            else:
+                allresults.update(results)
+        if not unchecked:
+            return allresults
+
+        aspellexe = self.aspell_exe or self.which_aspell()
+        jobs = max(min(jobs, len(unchecked) // batchsize + 1), 1)
+
+        def check_part(part):
+            """ Check a part of the words with a new aspell process. """
+            partresults = {}
+            with ASpellPipe(aspellexe) as pipe:
+                for i in range(0, len(part), batchsize):
+                    batch = part[i:i + batchsize]
+                    results = pipe.check_word(' '.join(batch))
+                    for word in batch:
+                        partresults[word] = results.get(word, None)
+            return partresults
+
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            parts = executor.map(
+                check_part,
+                (unchecked[i::jobs] for i in range(jobs)))
+            for partresults in parts:
+                for word, corrected in partresults.items():
+                    self.cache.set(word, {word: corrected})
+                allresults.update(partresults)
+        return allresults
 
     def check_words(self, words):
         """ Checks an iterable of words using check_word() and merges
@@ -278,6 +575,183 @@ class SpellChecker(object):
         raise SpellChecker.NotSupported('Can\'t find the aspell executable.')
 
 
+class ASpellPipe(object):
+
+    """ A running `aspell -a` process, for checking many words without
+        starting a new process for each one.
+        Words are sent one line at a time, and aspell answers each line
+        with one result line per word, followed by a blank line.
+        Use it as a context manager, or call close() when finished.
+    """
+
+    def __init__(self, aspell_exe):
+        """ Starts aspell, raises SpellChecker.ASpellError if it doesn't
+            start properly.
+        """
+        self.proc = Popen(
+            [aspell_exe, '-a'],
+            stdin=PIPE,
+            stdout=PIPE,
+            stderr=PIPE)
+        # Aspell starts with a version line, like: @(#) International...
+        banner = self.proc.stdout.readline().decode('utf-8')
+        if not banner.startswith('@'):
+            self.close()
+            raise SpellChecker.ASpellError(
+                'Aspell failed to start:\n{}'.format(banner.strip()))
+        printdebug('Started aspell: {}'.format(banner.strip()))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type_, value, traceback):
+        self.close()
+        return False
+
+    def check_word(self, s):
+        """ Check a string/word for correctness.
+            This works like SpellChecker.check_word(), using the running
+            process.
+            Return a dict of {misspelled: possible_corrections}
+            Raises SpellChecker.ASpellError if aspell has quit.
+        """
+        # The ^ keeps aspell from treating the line as a command.
+        line = '^{}\n'.format(' '.join(s.split()))
+        try:
+            self.proc.stdin.write(line.encode('utf-8'))
+            self.proc.stdin.flush()
+        except BrokenPipeError as ex:
+            raise SpellChecker.ASpellError(
+                'Aspell quit unexpectedly:\n{}'.format(self.errors())) from ex
+        outlines = []
+        for outline in iter(self.proc.stdout.readline, b''):
+            outline = outline.decode('utf-8').strip('\n')
+            if not outline:
+                # Blank line, end of the results for this line.
+                return SpellChecker.parse_aspell(s, '\n'.join(outlines))
+            outlines.append(outline)
+        raise SpellChecker.ASpellError(
+            'Aspell quit unexpectedly:\n{}'.format(self.errors()))
+
+    def close(self):
+        """ Stop the aspell process. """
+        if self.proc.poll() is None:
+            try:
+                self.proc.stdin.close()
+            except BrokenPipeError:
+                pass
+            self.proc.wait()
+        self.proc.stdout.close()
+        self.proc.stderr.close()
+
+    def errors(self):
+        """ Returns anything aspell wrote to stderr, after it has quit. """
+        return self.proc.stderr.read().decode('utf-8').strip()
+
+
+class SpellCache(object):
+
+    """ A least-recently-used cache of aspell results, {word: results}.
+        It can be saved to a file, and loaded on the next run.
+        Saved results are only loaded when the key (aspell version and
+        dictionary) matches.
+        Hits and misses are counted, and the totals are saved with the file.
+    """
+
+    def __init__(self, key, maxsize=CACHESIZE, filename=None):
+        self.key = key
+        self.maxsize = maxsize
+        self.filename = filename
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        # Totals from previous runs, loaded from the file.
+        self.totalhits = 0
+        self.totalmisses = 0
+        self.changed = False
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, word):
+        """ Returns a copy of the cached results for a word, or None. """
+        results = self.entries.get(word, None)
+        if results is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(word)
+        return dict(results)
+
+    def load(self):
+        """ Load cached results from the file, if it exists and the key
+            matches. Returns True if anything was loaded.
+        """
+        if not self.filename:
+            return False
+        try:
+            with open(self.filename, 'r') as f:
+                data = json.load(f)
+        except (EnvironmentError, ValueError) as ex:
+            printdebug('Not loading spell cache: {}'.format(ex))
+            return False
+        if data.get('key', None) != self.key:
+            printdebug('Spell cache is for another aspell/dictionary.')
+            return False
+        self.totalhits = data.get('hits', 0)
+        self.totalmisses = data.get('misses', 0)
+        for word, results in data.get('entries', [])[-self.maxsize:]:
+            self.entries[word] = results
+        return bool(self.entries)
+
+    def save(self):
+        """ Save cached results to the file, if anything has changed.
+            Returns True if the file was written.
+        """
+        if not (self.filename and (self.changed or self.hits)):
+            return False
+        data = {
+            'key': self.key,
+            'hits': self.totalhits + self.hits,
+            'misses': self.totalmisses + self.misses,
+            # Least recently used first, so they are dropped first.
+            'entries': list(self.entries.items()),
+        }
+        tmpname = '{}.tmp'.format(self.filename)
+        try:
+            os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+            with open(tmpname, 'w') as f:
+                json.dump(data, f)
+            os.replace(tmpname, self.filename)
+        except EnvironmentError as ex:
+            printdebug('Unable to save spell cache: {}'.format(ex))
+            return False
+        return True
+
+    def set(self, word, results):
+        """ Cache results for a word, dropping the least recently used
+            results when the cache is full.
+        """
+        if self.maxsize < 1:
+            return
+        self.entries[word] = dict(results)
+        self.entries.move_to_end(word)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+        self.changed = True
+
+    def stats(self):
+        """ Returns a dict of cache statistics, for this run and overall. """
+        return {
+            'size': len(self.entries),
+            'maxsize': self.maxsize,
+            'hits': self.hits,
+            'misses': self.misses,
+            'totalhits': self.totalhits + self.hits,
+            'totalmisses': self.totalmisses + self.misses,
+        }
+
+
 class TempInput(object):
 
     """ Acts as STDIN for a Popen process.
@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+""" Latency tests for `define --complete`, which runs on every <TAB> press.
+    These use the real dictionary database next to define.py, and are
+    skipped when it hasn't been built yet (`./define.py -c -`).
+    Run with: python -m pytest tests
+"""
+
+import os
+import subprocess
+import sys
+import time
+import unittest
+
+ROOTDIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, ROOTDIR)
+import define  # noqa
+
+DEFINE = os.path.join(ROOTDIR, 'define.py')
+DICTDB = os.path.join(ROOTDIR, 'websters_dict_plain.sqlite3')
+# Prefixes to time. Single letters are the widest range queries.
+PREFIXES = ('', 'a', 'app', 'e', 'qu', 's', 'un', 'z', 'zzzzz')
+# Budget for a prefix query, in milliseconds.
+QUERYBUDGET = 10
+# Budget for a whole `--complete` run, in milliseconds, on top of the time
+# it takes to start the interpreter.
+STARTUPBUDGET = 100
+# Modules that are slow to import, and not needed for completion.
+SLOWMODULES = (
+    'concurrent.futures',
+    'docopt',
+    'http.server',
+    'logging',
+    'multiprocessing',
+    'spell',
+)
+# Number of runs to take the best time of, which is the least noisy.
+RUNS = 9
+
+
+def best_time(func, runs=RUNS):
+    """ Returns the best time for `func()`, in milliseconds. """
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return min(times) * 1000
+
+
+def run_complete(*args):
+    """ Run `define.py --complete` with arguments, and return its output
+        lines.
+    """
+    proc = subprocess.run(
+        (sys.executable, DEFINE, '--complete') + args,
+        stdout=subprocess.PIPE,
+        check=True,
+        universal_newlines=True)
+    return proc.stdout.splitlines()
+
+
+@unittest.skipUnless(
+    os.path.exists(DICTDB),
+    'No dictionary database: {}'.format(DICTDB))
+class CompleteTests(unittest.TestCase):
+
+    def test_completions(self):
+        """ Completions start with the prefix, in sorted order. """
+        for prefix in PREFIXES:
+            words = run_complete(prefix, '-n', '10')
+            self.assertLessEqual(len(words), 10)
+            self.assertEqual(words, sorted(words))
+            for word in words:
+                self.assertTrue(
+                    word.startswith(prefix),
+                    msg='{!r} does not start with {!r}'.format(word, prefix))
+        self.assertTrue(run_complete('a'), msg='No completions for: a')
+
+    def test_imports(self):
+        """ `--complete` doesn't import any of SLOWMODULES. """
+        proc = subprocess.run(
+            (sys.executable, '-X', 'importtime', DEFINE, '--complete', 'a'),
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+            check=True,
+            universal_newlines=True)
+        imported = {
+            line.rpartition('|')[-1].strip()
+            for line in proc.stderr.splitlines()
+        }
+        slow = sorted(imported.intersection(SLOWMODULES))
+        self.assertFalse(
+            slow,
+            msg='--complete imports slow modules: {}'.format(', '.join(slow)))
+
+    def test_query_budget(self):
+        """ Each prefix query is under QUERYBUDGET. """
+        for prefix in PREFIXES:
+            elapsed = best_time(lambda: define.complete_word(prefix))
+            self.assertLess(
+                elapsed,
+                QUERYBUDGET,
+                msg='--complete {!r}: {:.2f}ms'.format(prefix, elapsed))
+
+    def test_startup_budget(self):
+        """ A whole `--complete` run is under STARTUPBUDGET, after the time
+            it takes to start Python.
+        """
+        bare = best_time(
+            lambda: subprocess.run((sys.executable, '-c', 'pass'), check=True))
+        for prefix in ('a', 'app'):
+            elapsed = best_time(lambda: run_complete(prefix))
+            self.assertLess(
+                elapsed - bare,
+                STARTUPBUDGET,
+                msg='--complete {!r}: {:.1f}ms, python alone: {:.1f}ms'.format(
+                    prefix, elapsed, bare))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+""" Tests for the dictionary file tokenizer, which is shared by searching
+    (find_entries_infile()) and conversion (iter_definitions()).
+    Run with: python -m pytest tests
+"""
+
+import io
+import os
+import sys
+import unittest
+
+ROOTDIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, ROOTDIR)
+import define  # noqa
+
+# A small dictionary file. The 'Defn: A' line looks like a headword once
+# 'Defn: ' is removed, but it is part of FOO's definition.
+SAMPLE = '\n'.join((
+    'Header text',
+    'FOO',
+    'Foo, n.',
+    '',
+    'Defn: See BAR',
+    '',
+    'Defn: A',
+    'more',
+    'EMPTY',
+    '',
+    'BAR',
+    '  Bar, n.  ',
+    '1. One.',
+    '2. Two.',
+    'BAR',
+    'Bar, v.',
+    '*** END',
+    'NOTAWORD',
+    'Not a word.',
+)).encode(define.DICTENCODING)
+EXPECTED = [
+    ('FOO', 'Foo, n.\n\nSee BAR\n\nA\nmore'),
+    ('BAR', 'Bar, n.\n\n1. One.\n\n2. Two.'),
+    ('BAR', 'Bar, v.'),
+]
+# Read sizes to try, so entries and lines are split between reads.
+CHUNKSIZES = (1, 7, 64, define.CHUNKSIZE)
+
+
+class EntriesTests(unittest.TestCase):
+
+    def test_definitions(self):
+        """ iter_definitions() keeps 'Defn: ' lines in their entry. """
+        for chunksize in CHUNKSIZES:
+            with self.subTest(chunksize=chunksize):
+                self.assertEqual(
+                    list(iter_definitions(SAMPLE, chunksize)),
+                    EXPECTED)
+
+    def test_search_matches_conversion(self):
+        """ find_entries_infile() finds the same definitions that
+            iter_definitions() converts.
+        """
+        converted = {}
+        for word, definition in EXPECTED:
+            converted.setdefault(word, []).append(definition)
+        for chunksize in CHUNKSIZES:
+            with self.subTest(chunksize=chunksize):
+                self.assertEqual(
+                    dict(find_entries(SAMPLE, chunksize, ('foo', 'bar'))),
+                    converted)
+                self.assertEqual(
+                    dict(find_entries(SAMPLE, chunksize, ('A', 'NOTAWORD'))),
+                    {})
+
+
+def find_entries(data, chunksize, words):
+    """ Run find_entries_infile() on `data`, reading `chunksize` bytes at a
+        time.
+    """
+    return define.find_entries_infile(ChunkedFile(data, chunksize), words)
+
+
+def iter_definitions(data, chunksize):
+    """ Run iter_definitions() on `data`, reading `chunksize` bytes at a
+        time.
+    """
+    return define.iter_definitions(ChunkedFile(data, chunksize))
+
+
+class ChunkedFile(io.BytesIO):
+    """ A binary file that never returns more than `chunksize` bytes from
+        a read, however many are asked for.
+    """
+    def __init__(self, data, chunksize):
+        super().__init__(data)
+        self.chunksize = chunksize
+
+    def read(self, size=-1):
+        if (size is None) or (size < 0) or (size > self.chunksize):
+            size = self.chunksize
+        return super().read(size)
+
+
+if __name__ == '__main__':
+    unittest.main()